@@ -1,23 +1,180 @@
+from collections import namedtuple
+import csv
+from functools import lru_cache
+import json
+import math
+from statistics import NormalDist, fmean, stdev
+
+# decided is False when _max_samples ran out with the mean still inside the guard band
+AdaptiveResult = namedtuple('AdaptiveResult', ['passed', 'mean', 'samples', 'decided'])
+
+def _t_cdf(_t:float,_df:int):
+    # Student t CDF for integer degrees of freedom, closed form (Abramowitz & Stegun 26.7.3/26.7.4)
+    theta = math.atan(abs(_t)/math.sqrt(_df))
+    cos2 = math.cos(theta)**2
+    if _df % 2:
+        term = total = 1.0 if _df > 1 else 0.0
+        for k in range(3,_df - 1,2):
+            term *= cos2*(k - 1)/k
+            total += term
+        inside = 2/math.pi*(theta + math.sin(theta)*math.cos(theta)*total)
+    else:
+        term = total = 1.0
+        for k in range(2,_df - 1,2):
+            term *= cos2*(k - 1)/k
+            total += term
+        inside = math.sin(theta)*total
+    return 0.5 + math.copysign(inside/2,_t)
+
+@lru_cache(maxsize=256)
+def _t_quantile(_p:float,_df:int):
+    # Inverse of _t_cdf for _p > 0.5, by bisection
+    low, high = 0.0, 1.0
+    while _t_cdf(high,_df) < _p:
+        low, high = high, high*2
+    for _i in range(100):
+        middle = (low + high)/2
+        if _t_cdf(middle,_df) < _p:
+            low = middle
+        else:
+            high = middle
+    return high
+
 class BasicTests():
     def electric_test(self,_val,_max=None,_min=None,_logFlag=False):
         result = True
-        log = ''
         if _max != None:
-            log += f'MAX:{_max}\t'
             result = _val <= _max and result
         if _min != None:
-            log += f'MIN:{_min}\t'
             result = _val >= _min and result
-        log += f'VAL:{_val}\t'
-        log += 'OK' if result else 'NG'
         if _logFlag:
+            log = ''
+            if _max != None:
+                log += f'MAX:{_max}\t'
+            if _min != None:
+                log += f'MIN:{_min}\t'
+            log += f'VAL:{_val}\t'
+            log += 'OK' if result else 'NG'
             print(log)
         return result
-    
+
+    def adaptive_test(self,_measure,_max=None,_min=None,_confidence=0.99,_noise=None,_min_samples=1,_max_samples=10,_logFlag=False):
+        # _measure() takes one reading. Readings are added until the mean is further from every limit than
+        # the guard band q*sigma/sqrt(n), so a point far inside (or outside) the limits is decided on the
+        # first readings and only borderline ones use up to _max_samples. _noise is the known sigma of one
+        # reading (q from the normal distribution); without it sigma is estimated from the readings and q is
+        # the Student t quantile, which needs at least 3 readings. The mean is checked after every reading, so
+        # the error allowed per check is (1 - _confidence) / number of checks (Bonferroni). The chance that a point
+        # ends up decided on the wrong side is at most 1 - _confidence. For points close to a limit most runs end
+        # undecided (judged on the mean, decided=False), so among the decided ones the wrong share can be higher.
+        min_samples = min(max(_min_samples,1 if _noise is not None else 3),_max_samples)
+        if _noise is None and _max_samples < 3:
+            raise ValueError("Estimating the noise needs _max_samples >= 3, or pass _noise")
+        alpha = (1 - _confidence)/(_max_samples - min_samples + 1)
+        z = NormalDist().inv_cdf(1 - alpha)
+        limits = [limit for limit in (_max,_min) if limit is not None]
+        samples = []
+        decided = False
+        while len(samples) < _max_samples:
+            samples.append(float(_measure()))
+            if len(samples) < min_samples:
+                continue
+            mean = fmean(samples)
+            if math.isnan(mean):
+                break
+            if _noise is not None:
+                band = z*_noise/math.sqrt(len(samples))
+            else:
+                band = _t_quantile(1 - alpha,len(samples) - 1)*stdev(samples)/math.sqrt(len(samples))
+            if all(abs(mean - limit) > band for limit in limits):
+                decided = True
+                break
+        mean = fmean(samples)
+        if _logFlag:
+            print(f'N:{len(samples)}' + ('' if decided else '\tUNDECIDED'))
+        return AdaptiveResult(self.electric_test(mean,_max,_min,_logFlag),mean,len(samples),decided)
+
     def led_test(self,_rgb,_max,_min,_logFlag=False):
         result = []
         for i,color in enumerate(_rgb):
             result.append(self.electric_test(color,_max[i],_min[i],_logFlag))
         return result
-            
 
+class LimitTable():
+    # Compiled once per product; evaluate() checks a whole measurement vector in one pass
+    def __init__(self,_names,_min=None,_max=None,_units=None):
+        import numpy as np
+        self.names = tuple(_names)
+        count = len(self.names)
+        self.index = {name:i for i,name in enumerate(self.names)}
+        self.min = np.array([-np.inf if v is None else v for v in (_min if _min is not None else [None]*count)],dtype=float)
+        self.max = np.array([np.inf if v is None else v for v in (_max if _max is not None else [None]*count)],dtype=float)
+        self.units = tuple(_units) if _units is not None else ('',)*count
+        if not (len(self.min) == len(self.max) == len(self.units) == count):
+            raise ValueError("Names, limits and units must have the same length")
+
+    @classmethod
+    def from_rows(cls,_rows):
+        # _rows: iterable of {"name":..., "min":..., "max":..., "unit":...}, min/max/unit optional
+        names, mins, maxs, units = [], [], [], []
+        for row in _rows:
+            names.append(row["name"])
+            mins.append(cls._limit(row.get("min")))
+            maxs.append(cls._limit(row.get("max")))
+            units.append(row.get("unit") or '')
+        return cls(names,mins,maxs,units)
+
+    @classmethod
+    def load(cls,_path:str):
+        # JSON list of rows, or a CSV/tab separated file with a name,min,max,unit header
+        with open(_path,'r',encoding='utf-8') as _file:
+            if _path.lower().endswith('.json'):
+                return cls.from_rows(json.load(_file))
+            first = _file.readline()
+            _file.seek(0)
+            return cls.from_rows(csv.DictReader(_file,delimiter='\t' if '\t' in first else ','))
+
+    @staticmethod
+    def _limit(_value):
+        if _value is None or _value == '':
+            return None
+        return float(_value)
+
+    def __len__(self):
+        return len(self.names)
+
+    def evaluate(self,_values):
+        import numpy as np
+        values = np.asarray(_values,dtype=float)
+        if values.shape != self.min.shape:
+            raise ValueError(f"Expected {len(self.names)} values, got {values.shape}")
+        # Distance to the nearest limit, negative when outside; NaN readings fail
+        margin = np.minimum(values - self.min,self.max - values)
+        passed = margin >= 0
+        return LimitResult(self,values,passed,margin)
+
+class LimitResult():
+    def __init__(self,_table:LimitTable,_values,_passed,_margin):
+        self.table = _table
+        self.values = _values
+        self.passed = _passed
+        self.margin = _margin
+        self.ok = bool(_passed.all())
+
+    def failures(self):
+        return [self.table.names[i] for i in (~self.passed).nonzero()[0]]
+
+    def log(self,_only_failures:bool=True):
+        # Text is only built here, never during evaluate()
+        lines = []
+        indexes = (~self.passed).nonzero()[0] if _only_failures else range(len(self.table))
+        for i in indexes:
+            log = f'{self.table.names[i]}\t'
+            if self.table.max[i] != float('inf'):
+                log += f'MAX:{self.table.max[i]}\t'
+            if self.table.min[i] != float('-inf'):
+                log += f'MIN:{self.table.min[i]}\t'
+            log += f'VAL:{self.values[i]}{self.table.units[i]}\t'
+            log += 'OK' if self.passed[i] else 'NG'
+            lines.append(log)
+        return lines
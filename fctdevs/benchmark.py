@@ -0,0 +1,181 @@
+import argparse
+import json
+import subprocess
+import sys
+import time as t
+
+from .fct_devs import DAQ, PowerSource, FEASA, IOCard, Relay, DigitalOutputDev, OutputTransaction, rgbimModule
+from .simulation import FakeResourceManager, FakeFeasaDLL, FakeIOPortDLL
+
+# Representative board: 60 DAQ test points, 20 LED fibers, 2x16 RGBIM LEDs, 8 DAQ relays and 8 IO card outputs
+DEFAULTS = {
+    'boards': 5,
+    'points': 60,
+    'fibers': 20,
+    'leds': 16,
+    'relays': 8,
+    'visa_latency': 0.002,
+    'feasa_latency': 0.004,
+    'capture': 0.05,
+    'io_update': 0.008,
+    'jitter': 0.0,
+}
+
+class Station():
+    # One simulated fixture: DAQ + PowerSource on a fake VISA bus, FEASA and IOCard on fake DLLs
+    def __init__(self, _config:dict):
+        self.config = _config
+        self.rm = FakeResourceManager(_config['visa_latency'], _config['jitter'], _values={r'MEAS:VOLT:DC\?': '5.0', r'MEAS:RES\?': '100.0'})
+        self.feasa_dll = FakeFeasaDLL(_config['fibers'], _config['feasa_latency'], _config['capture'], _config['jitter'])
+        self.io_dll = FakeIOPortDLL(_config['io_update'], _config['jitter'])
+        self.daq = DAQ(self.rm, 'SIM::DAQ')
+        self.psu = PowerSource(self.rm, 'SIM::PSU')
+        self.feasa = FEASA(_dll=self.feasa_dll)
+        self.iocard = IOCard(_dll=self.io_dll)
+        self.points = [101 + i % 20 + 100 * (i // 20) for i in range(_config['points'])]
+        self.fibers = list(range(1, _config['fibers'] + 1))
+        self.modules = [rgbimModule(1, list(range(1, _config['leds'] + 1))), rgbimModule(2, list(range(1, _config['leds'] + 1)))]
+        self.relays = [Relay(0, 401 + i, self.daq) for i in range(_config['relays'])]
+        self.relays += [Relay(1, i, self.iocard, DigitalOutputDev.HANDLER_IOCard) for i in range(_config['relays'])]
+        self.plan = self.iocard.rgbim_plan(self.modules)
+
+    def calls(self):
+        return {
+            'visa': self.rm.round_trips(),
+            'feasa_dll': sum(self.feasa_dll.calls.values()),
+            'io_update': self.io_dll.calls['io_Update'],
+            'io_dll': sum(self.io_dll.calls.values()),
+        }
+
+def baseline_board(_station:Station):
+    # Per-call API, as station code used it before scan lists, batching and bulk reads
+    psu = _station.psu
+    psu.set_voltage(12)
+    psu.set_current(1)
+    psu.on()
+    for relay in _station.relays:
+        relay.energize()
+    for channel in _station.points:
+        _station.daq.measure_voltage(channel)
+    _station.feasa.get_rgbs(_station.fibers)
+    _station.iocard.rgbims(_station.modules)
+    for relay in _station.relays:
+        relay.deenergize()
+    psu.off()
+
+def optimized_board(_station:Station):
+    psu = _station.psu
+    with psu.batch(False):
+        psu.set_voltage(12)
+        psu.set_current(1)
+        psu.on()
+    with OutputTransaction(*_station.relays):
+        for relay in _station.relays:
+            relay.energize()
+    _station.daq.scan(_station.points)
+    _station.feasa.get_rgbi_array(_station.fibers)
+    _station.plan.read()
+    with OutputTransaction(*_station.relays):
+        for relay in _station.relays:
+            relay.deenergize()
+    psu.off()
+
+# Importing the package must stay cheap and must not pull in the instrument backends
+IMPORT_BUDGET_MS = 50.0
+IMPORT_MODULES = ('fctdevs', 'fctdevs.fct_devs')
+HEAVY_MODULES = ('pyvisa', 'serial', 'numpy', 'ctypes')
+
+SCENARIOS = {
+    'baseline': baseline_board,
+    'optimized': optimized_board,
+}
+
+def run_scenario(_name:str, _config:dict):
+    station = Station(_config)
+    board = SCENARIOS[_name]
+    times = []
+    before = station.calls()
+    for _board in range(_config['boards']):
+        start = t.perf_counter()
+        board(station)
+        times.append(t.perf_counter() - start)
+    after = station.calls()
+    times.sort()
+    mean = sum(times) / len(times)
+    return {
+        'cycle_mean_s': mean,
+        'cycle_min_s': times[0],
+        'cycle_p95_s': times[min(len(times) - 1, int(round(0.95 * (len(times) - 1))))],
+        'boards_per_hour': 3600.0 / mean if mean else None,
+        'calls_per_board': {key: (after[key] - before[key]) / len(times) for key in after},
+    }
+
+def run(_config:dict=None, _scenarios=None):
+    config = dict(DEFAULTS, **(_config or {}))
+    return {name: run_scenario(name, config) for name in (_scenarios or SCENARIOS)}
+
+def import_cost(_module:str):
+    # Measured in a fresh interpreter: (milliseconds, heavy modules loaded by the import)
+    code = (f"import sys, time; start = time.perf_counter(); import {_module}; "
+            f"print((time.perf_counter() - start) * 1000); "
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.splitlines()
+    return float(output[0]), [module for module in output[1].split(',') if module]
+
+def check_imports(_budget_ms:float=IMPORT_BUDGET_MS):
+    # Returns (report lines, problems)
+    lines, problems = [], []
+    for module in IMPORT_MODULES:
+        milliseconds, heavy = import_cost(module)
+        lines.append(f"import {module:<18} {milliseconds:6.1f} ms (budget {_budget_ms:.0f} ms), backends loaded: {', '.join(heavy) or 'none'}")
+        if milliseconds > _budget_ms:
+            problems.append(f"import {module} took {milliseconds:.1f} ms")
+        if heavy:
+            problems.append(f"import {module} loaded {', '.join(heavy)}")
+    return lines, problems
+
+def compare(_results:dict, _reference:dict, _tolerance:float):
+    # Scenarios whose mean cycle time got more than _tolerance (fraction) slower than the reference
+    regressions = []
+    for name, result in _results.items():
+        reference = _reference.get(name)
+        if reference and result['cycle_mean_s'] > reference['cycle_mean_s'] * (1 + _tolerance):
+            regressions.append(f"{name}: {result['cycle_mean_s'] * 1000:.1f} ms vs {reference['cycle_mean_s'] * 1000:.1f} ms")
+    return regressions
+
+def report(_results:dict):
+    lines = []
+    for name, result in _results.items():
+        calls = ', '.join(f'{key}={value:g}' for key, value in result['calls_per_board'].items())
+        lines.append(f"{name:<10} mean {result['cycle_mean_s'] * 1000:8.1f} ms  p95 {result['cycle_p95_s'] * 1000:8.1f} ms  "
+                     f"{result['boards_per_hour']:8.0f} boards/h  calls/board: {calls}")
+    return lines
+
+def main(_argv=None):
+    parser = argparse.ArgumentParser(description="Cycle-time benchmark on simulated instruments")
+    for key, value in DEFAULTS.items():
+        parser.add_argument('--' + key.replace('_', '-'), type=type(value), default=value)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS))
+    parser.add_argument('--save', help="Write the results as JSON")
+    parser.add_argument('--compare', help="Reference JSON from --save; exit 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.10)
+    parser.add_argument('--import-budget-ms', type=float, default=IMPORT_BUDGET_MS)
+    args = parser.parse_args(_argv)
+    lines, problems = check_imports(args.import_budget_ms)
+    print('\n'.join(lines))
+    config = {key: getattr(args, key) for key in DEFAULTS}
+    results = run(config, args.scenario)
+    print('\n'.join(report(results)))
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as _file:
+            json.dump(results, _file, indent=2)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as _file:
+            regressions = compare(results, json.load(_file), args.tolerance)
+        problems += regressions
+    for problem in problems:
+        print(f"REGRESSION {problem}")
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,49 +1,321 @@
-import serial
+from __future__ import annotations
 import time as t
-import ctypes
-import pyvisa
+import threading
+import queue
+from array import array
+from typing import TYPE_CHECKING
+from .scpi_batch import SCPIBatch
+from .visa_sessions import get_session
+
+# serial, ctypes and the vendor DLLs are only loaded by the classes that use them, so a station
+# that only needs BasicTests, logFile or the VISA devices doesn't pay for (or need) the rest
+if TYPE_CHECKING:
+    import pyvisa
+
+def _windll(_name:str):
+    import ctypes
+    return ctypes.WinDLL(_name)
+
+class _LazyDLL():
+    # Loads the library on first use and declares each function's prototype the first time it is looked up.
+    # _prototypes: {function: (argtypes, restype)} with ctypes type names, argtypes None = leave undeclared
+    def __init__(self, _loader, _prototypes:dict):
+        self._loader = _loader
+        self._prototypes = _prototypes
+        self._library = None
+
+    def __getattr__(self, _name:str):
+        if _name.startswith('__'):
+            raise AttributeError(_name)
+        if self._library is None:
+            self._library = self._loader()
+        function = getattr(self._library, _name)
+        prototype = self._prototypes.get(_name)
+        if prototype is not None:
+            import ctypes
+            argtypes, restype = prototype
+            if argtypes is not None:
+                function.argtypes = [getattr(ctypes, argtype) for argtype in argtypes]
+            function.restype = getattr(ctypes, restype)
+        # Later lookups find the bound function directly
+        setattr(self, _name, function)
+        return function
+
+    def __getitem__(self, _name:str):
+        return getattr(self, _name)
+
+class _DAQState():
+    # What the instrument is configured for. Every DAQ object on the same VISA session shares one,
+    # so they can't serve each other's stale cache.
+    def __init__(self):
+        # Held for each configure + READ? so threads sharing the DAQ (e.g. Cover waits) take turns
+        self.lock = threading.RLock()
+        self.invalidate()
+
+    def invalidate(self):
+        # channel -> (function, range, resolution) the instrument is currently configured for
+        self.config_cache = {}
+        self.scan_list = None
+        # channel -> True (closed) / False (open) as last written
+        self.relay_states = {}
+        # Session generation the cache belongs to
+        self.generation = None
 
 class DAQ():
+    OK_RESULT = "OK"
+    FUNC_RESISTANCE = 'RES'
+    FUNC_VOLTAGE = 'VOLT:DC'
+    FUNC_CURRENT = 'CURR:DC'
+    FUNC_CAPACITANCE = 'CAP'
     def __init__(self, _rm:pyvisa.ResourceManager, _resource_name:str, _init_Instrument:bool = True):
         self.rm = _rm
         self.resource_name = _resource_name
+        # When fast_read is set the measure_* methods use the configure-once / READ? path
+        self.fast_read = False
+        self.buffered = None
+        self.staged_relays = None
+        self.state = _DAQState()
         if _init_Instrument:
             self.open_instrument()
         else:
             self.instrument = None
 
     def open_instrument(self):
-        try:
-            self.instrument = self.rm.open_resource(self.resource_name,access_mode=1,open_timeout=3000)
-        except Exception as e:
-            print(f"Error opening instrument: {e}")
-            self.instrument = None
+        # Shared session, opened on first use and reconnected after failures
+        self.instrument = get_session(self.rm, self.resource_name)
+        self.state = self.instrument.shared_state('DAQ', _DAQState)
+
+    @property
+    def lock(self):
+        return self.state.lock
+
+    @property
+    def config_cache(self):
+        return self.state.config_cache
+
+    @property
+    def relay_states(self):
+        return self.state.relay_states
+
+    @property
+    def scan_list(self):
+        return self.state.scan_list
+
+    @scan_list.setter
+    def scan_list(self, _scan_list):
+        self.state.scan_list = _scan_list
 
     def open_channel(self, _channel:int):
+        if self.staged_relays is not None:
+            self.staged_relays[_channel] = False
+            return
         self.instrument.write(f'ROUT:OPEN (@{_channel})')
+        self.relay_states[_channel] = False
 
     def close_channel(self, _channel:int):
+        if self.staged_relays is not None:
+            self.staged_relays[_channel] = True
+            return
         self.instrument.write(f'ROUT:CLOSE (@{_channel})')
+        self.relay_states[_channel] = True
+
+    def begin_outputs(self):
+        # open_channel/close_channel only stage until commit_outputs()
+        self.staged_relays = {}
+
+    def discard_outputs(self):
+        self.staged_relays = None
+
+    def commit_outputs(self):
+        staged, self.staged_relays = self.staged_relays, None
+        if not staged:
+            return self.OK_RESULT
+        self._check_generation()
+        closes = [ch for ch, closed in staged.items() if closed and self.relay_states.get(ch) is not True]
+        opens = [ch for ch, closed in staged.items() if not closed and self.relay_states.get(ch) is not False]
+        commands = []
+        if closes:
+            commands.append(f'ROUT:CLOSE (@{self.channel_list(closes)})')
+        if opens:
+            commands.append(f'ROUT:OPEN (@{self.channel_list(opens)})')
+        if commands:
+            for channel in closes + opens:
+                self.relay_states.pop(channel, None)
+            self.instrument.write(';:'.join(commands))
+            for channel in closes + opens:
+                self.relay_states[channel] = staged[channel]
+        return self.OK_RESULT
+
+    def set_fast_read(self, _enabled:bool=True):
+        self.fast_read = _enabled
+
+    def invalidate_config(self):
+        self.state.invalidate()
+
+    def _check_generation(self):
+        # A reconnected session may be talking to a power-cycled instrument
+        generation = getattr(self.instrument, 'generation', None)
+        if generation != self.state.generation:
+            self.state.invalidate()
+            self.state.generation = generation
+
+    def _measure(self, _query:str, _channel:int, _setup:tuple):
+        # MEAS? reconfigures the channel and the scan list, so it holds the lock like configure + READ? does
+        with self.lock:
+            self._check_generation()
+            self.config_cache.pop(_channel, None)
+            self.scan_list = None
+            reply = self.instrument.query(_query)
+            # MEAS? leaves the channel configured as requested and as the only channel in the scan list
+            self.config_cache[_channel] = _setup
+            self.scan_list = (_channel,)
+        return float(reply)
 
     def measure_resistance(self, _channel:int, _ohm_range:int =100000, _resolution:float =0.03):
-        resistance = self.instrument.query(f'MEAS:RES? {_ohm_range},{_resolution}, (@{_channel})')
-        return float(resistance)
+        if self.fast_read:
+            return self.read(_channel, self.FUNC_RESISTANCE, _ohm_range, _resolution)
+        return self._measure(f'MEAS:RES? {_ohm_range},{_resolution}, (@{_channel})', _channel, (self.FUNC_RESISTANCE, _ohm_range, _resolution))
     
     def measure_voltage(self, _channel:int, _voltage_range:int=10):
-        voltage = self.instrument.query(f'MEAS:VOLT:DC? {_voltage_range},(@{_channel})')
-        return float(voltage)
+        if self.fast_read:
+            return self.read(_channel, self.FUNC_VOLTAGE, _voltage_range)
+        return self._measure(f'MEAS:VOLT:DC? {_voltage_range},(@{_channel})', _channel, (self.FUNC_VOLTAGE, _voltage_range, None))
     
     def measure_capacitance(self, _channel:int):
-        capacitance = self.instrument.query(f'MEAS:CAP? (@{_channel})')
-        return float(capacitance)
+        if self.fast_read:
+            return self.read(_channel, self.FUNC_CAPACITANCE)
+        return self._measure(f'MEAS:CAP? (@{_channel})', _channel, (self.FUNC_CAPACITANCE, None, None))
     
     def measure_current(self, _channel:int, _current_range:int=1):
-        voltage = self.instrument.query(f'MEAS:CURR:DC? {_current_range},(@{_channel})')
-        return float(voltage)
+        if self.fast_read:
+            return self.read(_channel, self.FUNC_CURRENT, _current_range)
+        return self._measure(f'MEAS:CURR:DC? {_current_range},(@{_channel})', _channel, (self.FUNC_CURRENT, _current_range, None))
+
+    def read(self, _channel:int, _function:str=FUNC_VOLTAGE, _range=None, _resolution=None):
+        return self.scan([_channel], _function, _range, _resolution)[_channel]
+
+    def scan(self, _channels, _function:str=FUNC_VOLTAGE, _range=None, _resolution=None, _functions:dict=None):
+        # _functions overrides the setup per channel: {channel: function} or {channel: (function, range, resolution)}
+        with self.lock:
+            channels = self.configure_scan(_channels, _function, _range, _resolution, _functions)
+            if not channels:
+                return {}
+            # The instrument always scans in ascending channel order
+            readings = self.instrument.query('READ?').split(',')
+        return dict(zip(channels, map(float, readings)))
+
+    def configure_scan(self, _channels, _function:str=FUNC_VOLTAGE, _range=None, _resolution=None, _functions:dict=None, _commands:list=()):
+        # Sends the CONF/ROUT:SCAN still missing plus any extra _commands in one write, returns the sorted channels
+        channels = sorted(set(_channels))
+        if not channels:
+            return channels
+        self._check_generation()
+        groups = {}
+        for channel in channels:
+            setup = (_function, _range, _resolution)
+            if _functions is not None and channel in _functions:
+                setup = _functions[channel]
+                if isinstance(setup, str):
+                    setup = (setup, None, None)
+            groups.setdefault(tuple(setup), []).append(channel)
+        # Only channels whose cached setup differs are reconfigured
+        commands = []
+        for setup, group in groups.items():
+            stale = [channel for channel in group if self.config_cache.get(channel) != setup]
+            if stale:
+                commands.append(self.conf_command(setup, stale))
+                # Forget them until the write succeeds so a failed write can't leave a wrong entry
+                for channel in stale:
+                    self.config_cache.pop(channel, None)
+        scan_list = tuple(channels)
+        # CONF redefines the scan list, so it has to be restored after any reconfiguration
+        if commands or self.scan_list != scan_list:
+            commands.append(f'ROUT:SCAN (@{self.channel_list(channels)})')
+            self.scan_list = None
+        commands.extend(_commands)
+        if commands:
+            self.instrument.write(';:'.join(commands))
+            for setup, group in groups.items():
+                for channel in group:
+                    self.config_cache[channel] = setup
+            self.scan_list = scan_list
+        return channels
+
+    def arm_buffered(self, _channels, _samples:int, _interval:float, _function:str=FUNC_VOLTAGE, _range=None, _resolution=None):
+        # Hardware-timed acquisition: one scan of _channels every _interval seconds, _samples times
+        if isinstance(_channels, int):
+            _channels = [_channels]
+        commands = ['TRIG:SOUR TIM', f'TRIG:TIM {_interval}', f'TRIG:COUN {_samples}',
+                    'FORM:DATA REAL,64', 'FORM:BORD NORM', 'INIT']
+        channels = self.configure_scan(_channels, _function, _range, _resolution, _commands=commands)
+        self.buffered = (len(channels), _samples, _interval)
+        return channels
+
+    def fetch_buffered(self):
+        # Returns (timestamps, readings); readings has one column per channel when more than one is scanned
+        import numpy as np
+        n_channels, samples, interval = self.buffered
+        timeout = self.instrument.timeout
+        try:
+            # FETC? blocks until the last trigger, so the timeout has to cover the whole acquisition
+            self.instrument.timeout = timeout + samples * interval * 1000
+            # Read by the block's declared length: a 0x0A byte in the data must not end the read
+            # on sessions with a termination character (serial, socket)
+            readings = self.instrument.query_binary_values('FETC?', datatype='d', is_big_endian=True, container=np.array)
+        finally:
+            self.instrument.timeout = timeout
+            self.instrument.write('FORM:DATA ASC;:TRIG:SOUR IMM;:TRIG:COUN 1')
+            self.buffered = None
+        if n_channels > 1:
+            readings = readings.reshape(-1, n_channels)
+        timestamps = np.arange(len(readings)) * interval
+        return timestamps, readings
+
+    def measure_buffered(self, _channels, _samples:int, _interval:float, _function:str=FUNC_VOLTAGE, _range=None, _resolution=None):
+        self.arm_buffered(_channels, _samples, _interval, _function, _range, _resolution)
+        return self.fetch_buffered()
+
+    @staticmethod
+    def conf_command(_setup:tuple, _channels):
+        function, _range, resolution = _setup
+        params = []
+        if _range is not None or resolution is not None:
+            params.append('AUTO' if _range is None else str(_range))
+        if resolution is not None:
+            params.append(str(resolution))
+        params.append(f'(@{DAQ.channel_list(_channels)})')
+        return f'CONF:{function} ' + ','.join(params)
+
+    @staticmethod
+    def channel_list(_channels):
+        # [101,102,103,105] -> '101:103,105'
+        channels = sorted(set(_channels))
+        items = []
+        start = prev = channels[0]
+        for channel in channels[1:] + [None]:
+            if channel is not None and channel == prev + 1:
+                prev = channel
+                continue
+            items.append(str(start) if start == prev else f'{start}:{prev}')
+            start = prev = channel
+        return ','.join(items)
+
+    def batch(self, _check_errors:bool=True):
+        # with dev.batch() as b: ... queues every write and b.query() until the block ends
+        return SCPIBatch(self, _check_errors)
 
     def close(self):
         self.instrument.close()
 
+def _profile_steps(_voltages, _currents, _dwells):
+    # A single current or dwell applies to every step
+    voltages = list(_voltages)
+    currents = [_currents] * len(voltages) if isinstance(_currents, (int, float)) else list(_currents)
+    dwells = [_dwells] * len(voltages) if isinstance(_dwells, (int, float)) else list(_dwells)
+    if not voltages or len(currents) != len(voltages) or len(dwells) != len(voltages):
+        raise ValueError(f"Profile needs the same number of voltages, currents and dwells ({len(voltages)}, {len(currents)}, {len(dwells)})")
+    return voltages, currents, dwells
+
 class PowerSource():
     def __init__(self, _rm:pyvisa.ResourceManager, resource_name:str, _init_Instrument:bool = True):
         self.rm = _rm
@@ -53,12 +325,8 @@ class PowerSource():
         else:
             self.instrument = None
 
-    def open_instrument(self):        
-        try:
-            self.instrument = self.rm.open_resource(self.resource_name,access_mode=1,open_timeout=3000)
-        except Exception as e:
-            print(f"Error opening instrument: {e}")
-            self.instrument = None
+    def open_instrument(self):
+        self.instrument = get_session(self.rm, self.resource_name)
 
     def set_voltage(self, _voltage:float, _channel:str='CH1'):
         self.instrument.write(f':{_channel}:VOLTage {_voltage}')
@@ -77,6 +345,29 @@ class PowerSource():
 
     def measure_current(self,_channel:str='CH1'):
         return float(self.instrument.query(f'MEAS:CURR? {_channel}'))    
+
+    def measure_all(self,_channel:str='CH1'):
+        # Voltage, current and power in one query
+        return tuple(float(value) for value in self.instrument.query(f'MEAS:ALL? {_channel}').split(','))
+
+    def upload_profile(self, _voltages, _currents, _dwells, _channel:str='CH1', _cycles:int=1, _end_state:str='OFF'):
+        # Timer mode: every group (V, A, seconds) goes in one message, run_profile() starts it
+        voltages, currents, dwells = _profile_steps(_voltages, _currents, _dwells)
+        commands = [f':TIMEr:PARAmeter {_channel},{i},{v:g},{c:g},{d:g}' for i,(v,c,d) in enumerate(zip(voltages, currents, dwells))]
+        commands += [f':TIMEr:GROUPs {_channel},{len(voltages)}', f':TIMEr:CYCLEs {_channel},N,{_cycles}',
+                     f':TIMEr:ENDState {_channel},{_end_state}']
+        self.instrument.write(';'.join(commands))
+
+    def run_profile(self, _channel:str='CH1'):
+        # The timer only runs while the output is on
+        self.instrument.write(f':OUTPut {_channel},ON;:TIMEr {_channel},ON')
+
+    def stop_profile(self, _channel:str='CH1'):
+        self.instrument.write(f':TIMEr {_channel},OFF')
+
+    def batch(self, _check_errors:bool=True):
+        return SCPIBatch(self, _check_errors)
+
     def close(self):
         self.instrument.close()
 
@@ -84,17 +375,15 @@ class PowerSource_KeySight():
     def __init__(self, _rm:pyvisa.ResourceManager, resource_name:str, _init_Instrument:bool = True):
         self.rm = _rm
         self.resource_name = resource_name
+        # Transient trigger source of the uploaded list, see upload_profile()
+        self.trigger_source = 'BUS'
         if _init_Instrument:
             self.open_instrument()
         else:
             self.instrument = None
 
-    def open_instrument(self):        
-        try:
-            self.instrument = self.rm.open_resource(self.resource_name,access_mode=1,open_timeout=3000)
-        except Exception as e:
-            print(f"Error opening instrument: {e}")
-            self.instrument = None
+    def open_instrument(self):
+        self.instrument = get_session(self.rm, self.resource_name)
 
     def set_voltage(self, _voltage:float):
         self.instrument.write(f'VOLT {_voltage}')
@@ -105,16 +394,64 @@ class PowerSource_KeySight():
     def measure_current(self):
         return float(self.instrument.query('MEAS:CURR:DC?'))
 
+    def upload_profile(self, _voltages, _currents, _dwells, _count:int=1, _trigger_source:str='BUS'):
+        # List mode: the whole sequence and the transient trigger source go in one message.
+        # _trigger_source 'BUS' is started by run_profile(), 'EXT' waits for the trigger input.
+        voltages, currents, dwells = _profile_steps(_voltages, _currents, _dwells)
+        self.trigger_source = _trigger_source
+        self.instrument.write(';:'.join([
+            'LIST:VOLT ' + ','.join(f'{v:g}' for v in voltages),
+            'LIST:CURR ' + ','.join(f'{c:g}' for c in currents),
+            'LIST:DWEL ' + ','.join(f'{d:g}' for d in dwells),
+            f'LIST:COUN {_count}', 'VOLT:MODE LIST', 'CURR:MODE LIST', f'TRIG:TRAN:SOUR {_trigger_source}']))
+
+    def run_profile(self, _points:int=0, _interval:float=None):
+        # Arms the list and, with _points, a measurement sweep of _points readings every _interval seconds
+        # started by the same trigger; fetch_profile() reads it back
+        commands = []
+        if _points:
+            commands += [f'SENS:SWE:POIN {_points}', f'TRIG:ACQ:SOUR {self.trigger_source}', 'INIT:ACQ']
+            if _interval is not None:
+                commands.insert(1, f'SENS:SWE:TINT {_interval:g}')
+        commands.append('INIT:TRAN')
+        if self.trigger_source == 'BUS':
+            commands.append('*TRG')
+        self.instrument.write(';:'.join(commands))
+
+    def fetch_profile(self, _timeout:int=None):
+        # (voltages, currents) arrays from the measurement buffer; FETC waits for the sweep to finish,
+        # so _timeout (ms) should cover the whole profile
+        import numpy as np
+        timeout = self.instrument.timeout
+        if _timeout is not None:
+            self.instrument.timeout = _timeout
+        try:
+            voltages, currents = self.instrument.query('FETC:ARR:VOLT?;:FETC:ARR:CURR?').split(';')
+        finally:
+            self.instrument.timeout = timeout
+        return np.array(voltages.split(','), dtype=float), np.array(currents.split(','), dtype=float)
+
+    def stop_profile(self):
+        # Back to fixed voltage/current
+        self.instrument.write('ABOR:TRAN;:ABOR:ACQ;:VOLT:MODE FIX;:CURR:MODE FIX')
+
     def on(self):
         self.instrument.write(f'OUTP ON')
 
     def off(self):
         self.instrument.write(f'OUTP OFF')
 
+    def batch(self, _check_errors:bool=True):
+        return SCPIBatch(self, _check_errors)
+
     def close(self):
         self.instrument.close()
 
 class Cover():
+    CLOSED_OHMS = 500
+    # Coarsest setup that still tells the switch states apart: 1 kOhm range, MAX resolution (shortest aperture)
+    WAIT_RANGE = 1000
+    WAIT_RESOLUTION = 'MAX'
     def __init__(self,_canal:int,_daq:DAQ):
         self.canal = _canal
         self.daq = _daq
@@ -122,67 +459,201 @@ class Cover():
     def is_closed(self):
         try:
             resistance = self.daq.measure_resistance(self.canal)
-        except:
+        except Exception:
             resistance = 999999
-        finally:
-            return resistance < 500
+        return resistance < self.CLOSED_OHMS
+
+    def _poll(self):
+        # Open circuit reads as overload (+9.9E37) on the 1 kOhm range, errors count as open too
+        try:
+            return self.daq.read(self.canal, DAQ.FUNC_RESISTANCE, self.WAIT_RANGE, self.WAIT_RESOLUTION) < self.CLOSED_OHMS
+        except Exception:
+            return False
+
+    def wait_until_closed(self, _timeout:float=None, _debounce:int=3, _fast:float=0.01, _slow:float=0.2):
+        return self._wait(True, _timeout, _debounce, _fast, _slow)
+
+    def wait_until_open(self, _timeout:float=None, _debounce:int=3, _fast:float=0.01, _slow:float=0.2):
+        return self._wait(False, _timeout, _debounce, _fast, _slow)
+
+    def _wait(self, _closed:bool, _timeout:float, _debounce:int, _fast:float, _slow:float):
+        # Returns True once _debounce readings in a row are in the wanted state, False on timeout.
+        # The poll interval starts at _fast, backs off towards _slow while nothing changes and drops
+        # back to _fast on any change (the operator is moving the lid). The DAQ lock is only held
+        # for each reading, so other steps get the DAQ in between.
+        deadline = None if _timeout is None else t.monotonic() + _timeout
+        interval = _fast
+        previous = None
+        count = 0
+        while True:
+            state = self._poll()
+            count = count + 1 if state == _closed else 0
+            if count >= _debounce:
+                return True
+            if state != previous or count:
+                interval = _fast
+            else:
+                interval = min(interval * 1.5, _slow)
+            previous = state
+            if deadline is not None:
+                remaining = deadline - t.monotonic()
+                if remaining <= 0:
+                    return False
+                interval = min(interval, remaining)
+            t.sleep(interval)
 
 class Scanner():
-    def __init__(self, _port:str):
+    def __init__(self, _port:str, _terminator:bytes=b'\r'):
         self.port = _port
+        self.terminator = _terminator
+        # Persistent port, only used after open() / start_reader()
+        self.ser = None
+        self.scans = queue.Queue()
+        self.reader = None
+        self.reading = False
 
     def set_port(self, _port:str):
+        if self.ser is not None:
+            self.close()
         self.port = _port
 
+    def open(self, _baudrate:int=115200):
+        import serial
+        if self.port is None:
+            raise ValueError("COM port not set. Please set the COM port before scanning.")
+        if self.ser is None:
+            self.ser = serial.Serial(port=self.port, baudrate=_baudrate, timeout=0.1)
+
+    def close(self):
+        self.stop_reader()
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
+
+    def _read_code(self, _ser, _timeout:float, _serial_len:int):
+        # Returns as soon as the terminator or _serial_len bytes arrive, or at the deadline
+        _ser.timeout = _timeout
+        serialpcb = _ser.read_until(self.terminator, _serial_len)
+        if not serialpcb:
+            return None
+        return serialpcb.decode("utf-8").strip()
+
     def scan_serial_HW(self, _baudrate:int=115200, _timeout:int=3,_serial_len:int = 21,_trigger_str:bytes = b'T\r\n'):
+        import serial
         if self.port is None:
             raise ValueError("COM port not set. Please set the COM port before scanning.")
         try:
+            if self.reading:
+                # A code scanned ahead by the operator is used first
+                try:
+                    return self.scans.get_nowait()[1]
+                except queue.Empty:
+                    pass
+                self.ser.write(_trigger_str)
+                return self.get_scan(_timeout)
+            if self.ser is not None:
+                self.ser.reset_input_buffer()
+                self.ser.write(_trigger_str)
+                return self._read_code(self.ser, _timeout, _serial_len)
             with serial.Serial(port=self.port, baudrate=_baudrate, timeout=_timeout) as ser:
                 ser.write(_trigger_str)
-                t.sleep(1)
-                serialpcb = ser.read(_serial_len)
-                if not serialpcb:
-                    return None
-                return serialpcb.decode("utf-8")
+                return self._read_code(ser, _timeout, _serial_len)
         except(serial.SerialException,UnicodeDecodeError):
             return None
 
-        return serialpcb
-    
-    def scan_serial_trigger(self, _daq:DAQ):
+    def start_reader(self, _baudrate:int=115200, _serial_len:int=None):
+        # Background reader: every code the scanner sends is queued as (timestamp, code)
+        self.open(_baudrate)
+        if self.reading:
+            return
+        self.ser.timeout = 0.1
+        self.reading = True
+        self.reader = threading.Thread(target=self._reader, args=(_serial_len,), name="Scanner", daemon=True)
+        self.reader.start()
+
+    def stop_reader(self):
+        self.reading = False
+        if self.reader is not None:
+            self.reader.join()
+            self.reader = None
+
+    def _reader(self, _serial_len:int):
+        import serial
+        data = bytearray()
+        while self.reading:
+            try:
+                data += self.ser.read_until(self.terminator, _serial_len - len(data) if _serial_len else None)
+            except serial.SerialException:
+                self.reading = False
+                break
+            if data.endswith(self.terminator) or (_serial_len and len(data) >= _serial_len):
+                code = data.decode("utf-8", errors="replace").strip()
+                data.clear()
+                if code:
+                    self.scans.put((t.time(), code))
+
+    def get_scan(self, _timeout:float=None):
+        try:
+            return self.scans.get(timeout=_timeout)[1]
+        except queue.Empty:
+            return None
+
+    def get_scans(self):
+        # Every queued (timestamp, code) without waiting
+        scans = []
+        while True:
+            try:
+                scans.append(self.scans.get_nowait())
+            except queue.Empty:
+                return scans
+
+    def scan_serial_trigger(self, _daq:DAQ, _pulse:float=0.1):
         if self.port is None:
             raise ValueError("COM port not set. Please set the COM port before scanning.")
-        _daq.write(f'ROUT:CLOSE (@{int(self.port)})')
-        t.sleep(1)
-        _daq.write(f'ROUT:OPEN (@{int(self.port)})')
+        _daq.close_channel(int(self.port))
+        t.sleep(_pulse)
+        _daq.open_channel(int(self.port))
 
 class FEASA():
     BITNESS_32_BITS = 0
     BITNESS_64_BITS = 1
-    def __init__(self, _buffer_size:int=32, _port:int=4,_timeout:int=8000,_baudrate:bytes=b'57600',_bitness:int = BITNESS_64_BITS):
+    ALL_RGBI_COMMAND = b'GetRGBIAll'
+    BULK_MAX_FAILURES = 3
+    PROTOTYPES = {
+        'FeasaCom_Open': (['c_int', 'c_char_p'], 'c_int'),
+        'FeasaCom_Close': (['c_int'], 'c_int'),
+        'FeasaCom_Send': (['c_int', 'c_char_p', 'c_char_p'], 'c_int'),
+        'FeasaCom_EnumPorts': (None, 'c_int'),
+        'FeasaCom_SetResponseTimeout': (['c_uint'], 'c_int'),
+    }
+    def __init__(self, _buffer_size:int=32, _port:int=4,_timeout:int=8000,_baudrate:bytes=b'57600',_bitness:int = BITNESS_64_BITS,_bulk_buffer_size:int=4096,_dll=None):
+        import ctypes
         self.buffer = ctypes.create_string_buffer(_buffer_size)
+        # Reused by the all-fiber commands, big enough for one line per fiber
+        self.bulk_buffer = ctypes.create_string_buffer(_bulk_buffer_size)
+        self.bulk_supported = True
+        # Consecutive failed GetRGBIAll sends; timeouts only fall back for that capture
+        self.bulk_failures = 0
+        self.rgbi_commands = {}
         self.port = _port
         self.baudrate = _baudrate
-        if _bitness == self.BITNESS_64_BITS:
-            FeasaDLL = ctypes.WinDLL('feasacom64.dll')
-        if _bitness == self.BITNESS_32_BITS:
-            FeasaDLL = ctypes.WinDLL('feasacom.dll')
-        self.FeasaCom_Open = FeasaDLL['FeasaCom_Open']
-        self.FeasaCom_Open.argtypes = [ctypes.c_int, ctypes.c_char_p]
-        self.FeasaCom_Open.restype = ctypes.c_int
-        self.FeasaCom_Close = FeasaDLL['FeasaCom_Close']
-        self.FeasaCom_Close.argtypes = [ctypes.c_int]
-        self.FeasaCom_Close.restype = ctypes.c_int
-        self.FeasaCom_Send = FeasaDLL['FeasaCom_Send']
-        self.FeasaCom_Send.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_char_p]
-        self.FeasaCom_Send.restype = ctypes.c_int
-        self.FeasaCom_EnumPorts = FeasaDLL['FeasaCom_EnumPorts']
-        self.FeasaCom_EnumPorts.restype = ctypes.c_int
-        self.FeasaCom_SetResponseTimeout = FeasaDLL['FeasaCom_SetResponseTimeout']
-        self.FeasaCom_SetResponseTimeout.argtypes = [ctypes.c_uint]
-        self.FeasaCom_SetResponseTimeout.restype = ctypes.c_int
-        self.FeasaCom_SetResponseTimeout(_timeout)
+        # Applied on open(), so the DLL isn't loaded until the analyser is actually used
+        self.timeout = _timeout
+        # _dll replaces the vendor library, e.g. with simulation.FakeFeasaDLL
+        if _dll is not None:
+            self.dll = _LazyDLL(lambda: _dll, self.PROTOTYPES)
+        elif _bitness == self.BITNESS_64_BITS:
+            self.dll = _LazyDLL(lambda: _windll('feasacom64.dll'), self.PROTOTYPES)
+        elif _bitness == self.BITNESS_32_BITS:
+            self.dll = _LazyDLL(lambda: _windll('feasacom.dll'), self.PROTOTYPES)
+
+    def __getattr__(self, _name:str):
+        # FeasaCom_* are bound from the DLL the first time they are used, then stored on the instance
+        if _name not in self.PROTOTYPES:
+            raise AttributeError(_name)
+        function = getattr(self.dll, _name)
+        setattr(self, _name, function)
+        return function
     
     def set_port(self, _port:int):
         self.port = _port
@@ -191,6 +662,7 @@ class FEASA():
         self.baudrate = _baudrate
 
     def open(self):
+        self.FeasaCom_SetResponseTimeout(self.timeout)
         result = self.FeasaCom_Open(self.port, self.baudrate)
         if result != 1:
             return False
@@ -241,6 +713,70 @@ class FEASA():
             return None
         return result
     
+    def get_rgbi_array(self, _fibers:list, _use_all:bool=True):
+        # Returns (values, valid): values is a (fiber x R,G,B,I) float array with NaN wherever valid is False
+        import numpy as np
+        if self.capture() != 1:
+            return None
+        values = np.full((len(_fibers),4),np.nan)
+        valid = np.zeros(len(_fibers),dtype=bool)
+        self.read_rgbi_into(_fibers, values, valid, _use_all)
+        return values, valid
+
+    def read_rgbi_into(self, _fibers:list, _values, _valid, _use_all:bool=True):
+        # Reads the last capture into preallocated (fiber x 4) _values and (fiber) _valid arrays
+        rows = None
+        if _use_all and self.bulk_supported:
+            rows = self._read_all_rgbi(_fibers)
+        if rows is None:
+            rows = self._read_rgbi(_fibers)
+        for i,row in enumerate(rows):
+            if row is None:
+                _values[i] = float('nan')
+                _valid[i] = False
+            else:
+                _values[i] = row
+                _valid[i] = True
+
+    def _read_all_rgbi(self, _fibers:list):
+        self.bulk_buffer.value = b''
+        result = self.FeasaCom_Send(self.port,self.ALL_RGBI_COMMAND,self.bulk_buffer)
+        reply = self.bulk_buffer.value.decode(errors='replace')
+        if result != 1 or 'error' in reply.lower():
+            self.bulk_failures += 1
+            # Older firmware answers with an error: use the per-fiber commands from now on. Other failures
+            # (e.g. a timeout) only fall back for this capture unless they keep happening.
+            if 'error' in reply.lower() or self.bulk_failures >= self.BULK_MAX_FAILURES:
+                self.bulk_supported = False
+                print(f"FEASA: {self.ALL_RGBI_COMMAND.decode()} failed ({reply.strip() or result}), using per-fiber reads")
+            return None
+        self.bulk_failures = 0
+        lines = reply.splitlines()
+        return [self._parse_rgbi(lines[fiber-1]) if 0 < fiber <= len(lines) else None for fiber in _fibers]
+
+    def _read_rgbi(self, _fibers:list):
+        rows = []
+        send = self.FeasaCom_Send
+        for fiber in _fibers:
+            command = self.rgbi_commands.get(fiber)
+            if command is None:
+                command = self.rgbi_commands[fiber] = b'Getrgbi' + b'%02d'%fiber
+            if send(self.port,command,self.buffer) == 1:
+                rows.append(self._parse_rgbi(self.buffer.value.decode(errors='replace')))
+            else:
+                rows.append(None)
+        return rows
+
+    @staticmethod
+    def _parse_rgbi(_line:str):
+        segments = _line.split()
+        if len(segments) < 4:
+            return None
+        try:
+            return [float(segment) for segment in segments[-4:]]
+        except ValueError:
+            return None
+
     def get_intensity(self, _fiber:int):
         command = b'GetIntensity' + b'%02d'%_fiber
         if self.capture() == 1:
@@ -288,6 +824,143 @@ class FEASA():
             return False
         return True
 
+class FEASAStream():
+    CHANNEL_R = 0
+    CHANNEL_G = 1
+    CHANNEL_B = 2
+    CHANNEL_I = 3
+    def __init__(self, _feasa:FEASA, _fibers:list, _capacity:int=1024, _use_all:bool=True):
+        # Captures back to back on a background thread into a preallocated ring buffer of timestamped
+        # (fiber x R,G,B,I) frames. The FEASA must not be used by anything else while streaming.
+        import numpy as np
+        self.feasa = _feasa
+        self.fibers = list(_fibers)
+        self.capacity = _capacity
+        self.use_all = _use_all
+        self.frames = np.full((_capacity,len(self.fibers),4),np.nan)
+        self.valid = np.zeros((_capacity,len(self.fibers)),dtype=bool)
+        # time.monotonic() at the middle of each capture
+        self.times = np.zeros(_capacity)
+        # Frames written since start(), the newest one is at (count - 1) % capacity
+        self.count = 0
+        self.errors = 0
+        # Exception that stopped the acquisition thread, None while it runs normally
+        self.error = None
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.running:
+            return
+        with self.condition:
+            self.count = 0
+            self.errors = 0
+            self.error = None
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="FEASAStream", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        feasa = self.feasa
+        try:
+            while self.running:
+                slot = self.count % self.capacity
+                start = t.monotonic()
+                captured = feasa.capture() == 1
+                end = t.monotonic()
+                if captured:
+                    feasa.read_rgbi_into(self.fibers, self.frames[slot], self.valid[slot], self.use_all)
+                with self.condition:
+                    if captured:
+                        self.times[slot] = (start + end) / 2
+                        self.count += 1
+                    else:
+                        self.errors += 1
+                    self.condition.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            # Waiters must wake up whatever stopped the thread
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+
+    def wait_for(self, _frames:int, _timeout:float=None):
+        # Blocks until _frames frames have been captured since start()
+        with self.condition:
+            return self.condition.wait_for(lambda: self.count >= _frames or not self.running, _timeout) and self.count >= _frames
+
+    def snapshot(self, _since:float=None):
+        # (times, frames, valid) in chronological order, copied out of the ring. The slot being
+        # written is left out, so at most capacity - 1 frames come back.
+        import numpy as np
+        with self.condition:
+            count = min(self.count, self.capacity - 1)
+            index = np.arange(self.count - count, self.count) % self.capacity
+            times, frames, valid = self.times[index], self.frames[index], self.valid[index]
+        if _since is not None:
+            keep = times >= _since
+            times, frames, valid = times[keep], frames[keep], valid[keep]
+        return times, frames, valid
+
+    def minmax(self, _channel:int=CHANNEL_I, _since:float=None):
+        # Per fiber (min, max) arrays, NaN for fibers without a valid frame
+        _times, frames, valid = self.snapshot(_since)
+        return self._minmax(frames, valid, _channel)
+
+    @staticmethod
+    def _minmax(_frames, _valid, _channel:int):
+        import numpy as np
+        values = np.where(_valid, _frames[:,:,_channel], np.nan)
+        minimum = np.full(_frames.shape[1], np.nan)
+        maximum = np.full(_frames.shape[1], np.nan)
+        seen = _valid.any(axis=0)
+        minimum[seen] = np.nanmin(values[:,seen], axis=0)
+        maximum[seen] = np.nanmax(values[:,seen], axis=0)
+        return minimum, maximum
+
+    def _states(self, _channel:int, _threshold, _since:float):
+        # On/off per frame and fiber; the default threshold is halfway between each fiber's min and max
+        import numpy as np
+        times, frames, valid = self.snapshot(_since)
+        if _threshold is None:
+            # From the same frames the threshold is applied to
+            minimum, maximum = self._minmax(frames, valid, _channel)
+            _threshold = (minimum + maximum) / 2
+        values = frames[:,:,_channel]
+        with np.errstate(invalid='ignore'):
+            return times, values > _threshold, valid
+
+    def frequency(self, _channel:int=CHANNEL_I, _threshold=None, _since:float=None):
+        # Blink frequency in Hz per fiber from the rising edges, NaN with fewer than two edges
+        import numpy as np
+        times, on, valid = self._states(_channel, _threshold, _since)
+        result = np.full(len(self.fibers), np.nan)
+        rising = ~on[:-1] & on[1:] & valid[:-1] & valid[1:]
+        for i in range(len(self.fibers)):
+            edges = times[1:][rising[:,i]]
+            if len(edges) >= 2 and edges[-1] > edges[0]:
+                result[i] = (len(edges) - 1) / (edges[-1] - edges[0])
+        return result
+
+    def duty_cycle(self, _channel:int=CHANNEL_I, _threshold=None, _since:float=None):
+        # Fraction of time on per fiber, each frame holds until the next one; NaN without data
+        import numpy as np
+        times, on, valid = self._states(_channel, _threshold, _since)
+        if len(times) < 2:
+            return np.full(len(self.fibers), np.nan)
+        weights = np.diff(times)[:,None] * (valid[:-1] & valid[1:])
+        total = weights.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(total > 0, (weights * on[:-1]).sum(axis=0) / total, np.nan)
+
 class rgbimModule():
     def __init__(self,_valor:int,_fibras:list):
         self.valor = _valor
@@ -298,49 +971,51 @@ class IOCard():
     INDEX_RED = 0
     INDEX_GREEN = 1
     INDEX_BLUE = 2
-    def __init__(self):
-
-        # str that saves COM port
-        self.COM_port = None
-
-        self.io = ctypes.WinDLL("ioportlib.dll")
-
+    DIM16 = "dim16".encode('utf-8')
+    DOM16 = "dom16".encode('utf-8')
+    RGBIM = "rgbim".encode('utf-8')
+    PROTOTYPES = {
         # str = io.Err()
-        self.io.io_Err.restype = ctypes.c_char_p
-
+        'io_Err': (None, 'c_char_p'),
         # io.Open("COM1")
-        self.io.io_Open.restype = ctypes.c_bool
-        self.io.io_Open.argtypes = [ctypes.c_char_p]
-
+        'io_Open': (['c_char_p'], 'c_bool'),
         # io.Close()
-        self.io.io_Close.restype = ctypes.c_void_p
-
+        'io_Close': (None, 'c_void_p'),
         # Res = io.dim16Val(ModuleNum,InpNum)
-        self.io.io_dim16Val.restype = ctypes.c_bool
-        self.io.io_dim16Val.argtypes = [ctypes.c_int, ctypes.c_int]
-
+        'io_dim16Val': (['c_int', 'c_int'], 'c_bool'),
         # io.dom16Val(ModuleNum,OutNum,OutVal)
-        
-        self.io.io_dom16Val.restype = ctypes.c_void_p
-        self.io.io_dom16Val.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_bool]
-
+        'io_dom16Val': (['c_int', 'c_int', 'c_bool'], 'c_void_p'),
         # Res = io.lim16Val(ModuleNum,InpNum)
-        self.io.io_lim16Val.restype = ctypes.c_bool
-        self.io.io_lim16Val.argtypes = [ctypes.c_int, ctypes.c_int]
-
+        'io_lim16Val': (['c_int', 'c_int'], 'c_bool'),
         # Res = io.rgbimVal(ModuleNum,InpNum,ColorNum)
-        self.io.io_rgbimVal.restype = ctypes.c_int
-        self.io.io_rgbimVal.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int]
-
+        'io_rgbimVal': (['c_int', 'c_int', 'c_int'], 'c_int'),
         # Res = io.Update(ModuleNam,ModuleNum)
-        self.io.io_Update.restype = ctypes.c_bool
-        self.io.io_Update.argtypes = [ctypes.c_char_p, ctypes.c_int]
+        'io_Update': (['c_char_p', 'c_int'], 'c_bool'),
+    }
+    def __init__(self, _input_ttl:float=0.01, _dll=None):
+
+        # str that saves COM port
+        self.COM_port = None
+
+        # Inputs read less than input_ttl seconds after the module's last dim16 update are served from it
+        self.input_ttl = _input_ttl
+        self.input_updates = {}
+        self.lock = threading.RLock()
+
+        # (module, channel) -> value last pushed with io_Update, and the staged values while a transaction is open
+        self.output_states = {}
+        self.staged_outputs = None
+
+        # _dll replaces the vendor library, e.g. with simulation.FakeIOPortDLL
+        self.io = _LazyDLL((lambda: _dll) if _dll is not None else (lambda: _windll("ioportlib.dll")), self.PROTOTYPES)
 
     def set_port(self, _port:str):
             self.COM_port = _port
 
     def open(self):
         result = self.OK_RESULT
+        self.input_updates = {}
+        self.output_states = {}
         if not self.io.io_Open(self.COM_port.encode('utf-8')):
             result = self.io.io_Err().decode('utf-8')
         return result
@@ -350,22 +1025,91 @@ class IOCard():
         return self.OK_RESULT
     
     def output(self,_module:int,_outCanal:int,_value:bool):
-        self.io.io_dom16Val(_module,_outCanal,_value)
-        result = self.io.io_Update("dom16".encode('utf-8'),_module)
-        if result:
-            return self.OK_RESULT
-        else:
-            return self.io.io_Err()
+        with self.lock:
+            if self.staged_outputs is not None:
+                key = (_module,_outCanal)
+                if self.staged_outputs.get(key,self.output_states.get(key)) != _value:
+                    self.io.io_dom16Val(_module,_outCanal,_value)
+                    self.staged_outputs[key] = _value
+                return self.OK_RESULT
+            self.io.io_dom16Val(_module,_outCanal,_value)
+            result = self.io.io_Update(self.DOM16,_module)
+            if result:
+                self.output_states[(_module,_outCanal)] = _value
+                return self.OK_RESULT
+            else:
+                self.output_states.pop((_module,_outCanal),None)
+                return self.io.io_Err()
+
+    def begin_outputs(self):
+        # output() only stages values in the DLL until commit_outputs()
+        with self.lock:
+            self.staged_outputs = {}
+
+    def discard_outputs(self):
+        with self.lock:
+            staged, self.staged_outputs = self.staged_outputs, None
+            for (module,canal) in staged or {}:
+                previous = self.output_states.get((module,canal))
+                if previous is None:
+                    # Unknown hardware state: the staged value must not reach the next dom16 update,
+                    # so the buffer goes back to off and the state stays unknown
+                    self.io.io_dom16Val(module,canal,False)
+                    self.output_states.pop((module,canal),None)
+                else:
+                    self.io.io_dom16Val(module,canal,previous)
+
+    def commit_outputs(self):
+        with self.lock:
+            staged, self.staged_outputs = self.staged_outputs, None
+            result = self.OK_RESULT
+            changed = {key:value for key,value in (staged or {}).items() if self.output_states.get(key) != value}
+            for module in sorted({module for module,_canal in changed}):
+                keys = [key for key in changed if key[0] == module]
+                if self.io.io_Update(self.DOM16,module):
+                    for key in keys:
+                        self.output_states[key] = changed[key]
+                else:
+                    for key in keys:
+                        self.output_states.pop(key,None)
+                    if result == self.OK_RESULT:
+                        result = self.io.io_Err()
+            return result
         
+    def set_input_ttl(self,_ttl:float):
+        self.input_ttl = _ttl
+
+    def refresh_inputs(self,_module:int,_max_age:float=None):
+        # One dim16 update per module per TTL window, shared by every channel of that module
+        max_age = self.input_ttl if _max_age is None else _max_age
+        with self.lock:
+            updated = self.input_updates.get(_module)
+            if updated is not None and t.monotonic() - updated <= max_age:
+                return self.OK_RESULT
+            if self.io.io_Update(self.DIM16,_module):
+                self.input_updates[_module] = t.monotonic()
+                return self.OK_RESULT
+            self.input_updates.pop(_module,None)
+            return self.io.io_Err()
+
     def input(self,_module:int,_inCanal:int):
-        update_val = self.io.io_Update("dim16".encode('utf-8'),_module)
-        if update_val == True:
-            return [self.OK_RESULT,self.io.io_dim16Val(_module,_inCanal)]
-        else:
-            return [self.io.io_Err(),False]
+        with self.lock:
+            result = self.refresh_inputs(_module)
+            if result == self.OK_RESULT:
+                return [self.OK_RESULT,self.io.io_dim16Val(_module,_inCanal)]
+            else:
+                return [result,False]
+
+    def inputs(self,_module:int,_inCanales:list):
+        with self.lock:
+            result = self.refresh_inputs(_module)
+            if result == self.OK_RESULT:
+                return [self.OK_RESULT,[self.io.io_dim16Val(_module,canal) for canal in _inCanales]]
+            else:
+                return [result,[False]*len(_inCanales)]
         
     def rgbim(self,_module:int,_canal:int):
-        update_val = self.io.io_Update("rgbim".encode('utf-8'),_module)
+        update_val = self.io.io_Update(self.RGBIM,_module)
         if update_val == True:
             leds = [
                 self.io.io_rgbimVal(_module,_canal,self.INDEX_RED),
@@ -381,7 +1125,7 @@ class IOCard():
         update_val = True 
         
         for module in _modules:
-            update_val = update_val and self.io.io_Update("rgbim".encode('utf-8'),module.valor)
+            update_val = update_val and self.io.io_Update(self.RGBIM,module.valor)
         
         if update_val == True:
             for module in _modules:
@@ -395,8 +1139,43 @@ class IOCard():
             return [self.OK_RESULT,leds]
         else:
             return [self.io.io_Err(),leds]
-        
+
+    def rgbim_plan(self,_modules:list):
+        return RGBIMPlan(self,_modules)
+
     
+class RGBIMPlan():
+    # Readout plan built once from a list of rgbimModule; read() refills the same (LED x R,G,B) buffer every cycle
+    def __init__(self, _iocard:IOCard, _modules:list):
+        self.iocard = _iocard
+        self.modules = tuple(dict.fromkeys(module.valor for module in _modules))
+        self.leds = tuple((module.valor,fibra) for module in _modules for fibra in module.fibras)
+        self.labels = tuple(f"MOD{modulo}_FIB{fibra}" for modulo,fibra in self.leds)
+        self.index = {label:i for i,label in enumerate(self.labels)}
+        colors = (IOCard.INDEX_RED,IOCard.INDEX_GREEN,IOCard.INDEX_BLUE)
+        self.reads = tuple((modulo,fibra,color,i*3+j) for i,(modulo,fibra) in enumerate(self.leds) for j,color in enumerate(colors))
+        try:
+            import numpy as np
+            self.buffer = np.zeros(len(self.leds)*3,dtype=np.int32)
+            self.values = self.buffer.reshape(-1,3)
+        except ImportError:
+            # Flat array, LED i colour j at i*3+j
+            self.buffer = array('i',bytes(len(self.leds)*3))
+            self.values = self.buffer
+
+    def read(self):
+        io = self.iocard.io
+        update = io.io_Update
+        value = io.io_rgbimVal
+        buffer = self.buffer
+        with self.iocard.lock:
+            for modulo in self.modules:
+                if not update(IOCard.RGBIM,modulo):
+                    return [io.io_Err(),self.values]
+            for modulo,fibra,color,position in self.reads:
+                buffer[position] = value(modulo,fibra,color)
+        return [IOCard.OK_RESULT,self.values]
+
 class DigitalOutputDev():
     HANDLER_DAQ = 0
     HANDLER_IOCard = 1
@@ -467,6 +1246,39 @@ class PistonPinesProg(Relay):
     def __init__(self,_modulo:int,_canal:int,_handler,_handlerType:int=DigitalOutputDev.HANDLER_DAQ):
         super().__init__(_modulo,_canal,_handler,_handlerType)
 
+class OutputTransaction():
+    # with OutputTransaction(iocard, daq): relay.energize(); piston.setOFF(); ...
+    # Devices can be passed instead of handlers. Commits one update per touched module / one ROUT per direction.
+    OK_RESULT = IOCard.OK_RESULT
+    def __init__(self, *_handlers):
+        self.handlers = []
+        for handler in _handlers:
+            handler = getattr(handler, 'handler', handler)
+            if all(handler is not known for known in self.handlers):
+                self.handlers.append(handler)
+        self.result = None
+
+    def __enter__(self):
+        for handler in self.handlers:
+            handler.begin_outputs()
+        return self
+
+    def __exit__(self, _exc_type, _exc, _tb):
+        if _exc_type is not None:
+            for handler in self.handlers:
+                handler.discard_outputs()
+            return False
+        self.commit()
+        return False
+
+    def commit(self):
+        self.result = self.OK_RESULT
+        for handler in self.handlers:
+            result = handler.commit_outputs()
+            if result != self.OK_RESULT and self.result == self.OK_RESULT:
+                self.result = result
+        return self.result
+
 class DigitalInputDev():
     HANDLER_DAQ = 0
     HANDLER_IOCard = 1
@@ -493,4 +1305,101 @@ class BoardDetect(DigitalInputDev):
     
 class PCBDetect(BoardDetect):
     def __init__(self, _modulo:int, _canal:int, _handler, _handlerType = DigitalInputDev.HANDLER_IOCard):
-        super().__init__(_modulo, _canal, _handler, _handlerType)
\ No newline at end of file
+        super().__init__(_modulo, _canal, _handler, _handlerType)
+
+class InputWatcher():
+    EDGE_RISING = 0
+    EDGE_FALLING = 1
+    EDGE_BOTH = 2
+    def __init__(self, _iocard:IOCard, _period:float=0.02):
+        self.iocard = _iocard
+        self.period = _period
+        # (modulo, canal) -> last state read, None until the first poll
+        self.states = {}
+        self.callbacks = []
+        # Callbacks that raised, and the last of their exceptions; the watcher keeps polling
+        self.callback_errors = 0
+        self.callback_error = None
+        # Exception that stopped the polling thread (e.g. from the DLL), None while it runs normally
+        self.error = None
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def watch(self, _dev:DigitalInputDev, _callback=None, _edge:int=EDGE_BOTH):
+        # _callback(dev, state) runs on the watcher thread
+        with self.condition:
+            self.states.setdefault((_dev.modulo, _dev.canal), None)
+            if _callback is not None:
+                self.callbacks.append((_dev, _edge, _callback))
+
+    def state(self, _dev:DigitalInputDev):
+        with self.condition:
+            return self.states.get((_dev.modulo, _dev.canal))
+
+    def wait_for(self, _dev:DigitalInputDev, _state:bool=True, _timeout:float=None):
+        key = (_dev.modulo, _dev.canal)
+        self.watch(_dev)
+        if not self.running:
+            self.start()
+        with self.condition:
+            # Also returns (False) when the polling thread stops
+            return self.condition.wait_for(lambda: self.states.get(key) == _state or not self.running, _timeout) and self.states.get(key) == _state
+
+    def start(self):
+        if self.running:
+            return
+        self.error = None
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="InputWatcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        try:
+            while self.running:
+                self.poll()
+                t.sleep(self.period)
+        except Exception as e:
+            self.error = e
+        finally:
+            # Waiters must wake up whatever stopped the thread
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+
+    def poll(self):
+        with self.condition:
+            modules = {}
+            for modulo, canal in self.states:
+                modules.setdefault(modulo, []).append(canal)
+            callbacks = list(self.callbacks)
+        changes = []
+        for modulo, canales in modules.items():
+            result, values = self.iocard.inputs(modulo, canales)
+            if result != self.iocard.OK_RESULT:
+                continue
+            with self.condition:
+                for canal, value in zip(canales, values):
+                    previous = self.states.get((modulo, canal))
+                    if previous != value:
+                        self.states[(modulo, canal)] = value
+                        if previous is not None:
+                            changes.append((modulo, canal, value))
+                self.condition.notify_all()
+        for modulo, canal, value in changes:
+            for dev, edge, callback in callbacks:
+                if (dev.modulo, dev.canal) != (modulo, canal):
+                    continue
+                if edge == self.EDGE_BOTH or (edge == self.EDGE_RISING) == bool(value):
+                    # One failing callback must not stop the others or the watcher
+                    try:
+                        callback(dev, value)
+                    except Exception as e:
+                        self.callback_errors += 1
+                        self.callback_error = e
@@ -0,0 +1,227 @@
+from bisect import bisect_left
+import re
+import threading
+import time as t
+
+# Upper bounds in seconds, the last bucket catches everything above
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram():
+    def __init__(self, _buckets:tuple=BUCKETS):
+        self.buckets = _buckets
+        self.counts = [0] * (len(_buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, _seconds:float, _error:bool=False):
+        self.counts[bisect_left(self.buckets, _seconds)] += 1
+        self.count += 1
+        self.sum += _seconds
+        if _seconds > self.max:
+            self.max = _seconds
+        if _error:
+            self.errors += 1
+
+class Metrics():
+    def __init__(self, _buckets:tuple=BUCKETS):
+        self.buckets = tuple(_buckets)
+        # Attached wrappers check this flag first, so disabling costs one attribute read per call
+        self.enabled = True
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def record(self, _device:str, _command:str, _seconds:float, _error:bool=False):
+        with self.lock:
+            histogram = self.histograms.get((_device, _command))
+            if histogram is None:
+                histogram = self.histograms[(_device, _command)] = Histogram(self.buckets)
+            histogram.record(_seconds, _error)
+
+    def attach(self, _device, _name:str=None):
+        # Wraps the I/O entry points of an already opened device; returns the device
+        name = _name or type(_device).__name__
+        instrument = getattr(_device, 'instrument', None)
+        if instrument is not None and not isinstance(instrument, TimedResource):
+            _device.instrument = TimedResource(instrument, self, name)
+        for attribute in ('FeasaCom_Open', 'FeasaCom_Close', 'FeasaCom_Send', 'FeasaCom_EnumPorts', 'FeasaCom_SetResponseTimeout'):
+            function = getattr(_device, attribute, None)
+            if function is not None and not isinstance(function, TimedFunction):
+                setattr(_device, attribute, TimedFunction(function, self, name, attribute))
+        io = getattr(_device, 'io', None)
+        if io is not None and not isinstance(io, TimedLibrary):
+            _device.io = TimedLibrary(io, self, name)
+        for attribute in ('scan_serial_HW', 'get_scan', 'is_closed'):
+            method = getattr(_device, attribute, None)
+            if method is not None and not isinstance(method, TimedFunction):
+                setattr(_device, attribute, TimedFunction(method, self, name, attribute))
+        return _device
+
+    def rows(self):
+        with self.lock:
+            return sorted((device, command, histogram) for (device, command), histogram in self.histograms.items())
+
+    def to_csv(self, _path:str):
+        with open(_path, 'w', encoding='utf-8') as _file:
+            _file.write(','.join(['device', 'command', 'count', 'errors', 'sum_s', 'mean_s', 'max_s']
+                                 + [f'le_{bucket}' for bucket in self.buckets] + ['le_inf']) + '\n')
+            for device, command, histogram in self.rows():
+                mean = histogram.sum / histogram.count if histogram.count else 0.0
+                _file.write(','.join([device, f'"{command}"', str(histogram.count), str(histogram.errors),
+                                      f'{histogram.sum:.6f}', f'{mean:.6f}', f'{histogram.max:.6f}']
+                                     + [str(count) for count in histogram.counts]) + '\n')
+
+    def to_prometheus(self, _path:str, _prefix:str='fctdevs_call'):
+        # Prometheus text exposition format, buckets are cumulative; each metric family is one contiguous group
+        lines = [f'# HELP {_prefix}_duration_seconds Duration of instrument calls in seconds.',
+                 f'# TYPE {_prefix}_duration_seconds histogram']
+        errors = [f'# HELP {_prefix}_errors_total Instrument calls that raised or returned a failure result.',
+                  f'# TYPE {_prefix}_errors_total counter']
+        for device, command, histogram in self.rows():
+            labels = f'device="{self._escape(device)}",command="{self._escape(command)}"'
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'{_prefix}_duration_seconds_bucket{{{labels},le="{bucket}"}} {cumulative}')
+            lines.append(f'{_prefix}_duration_seconds_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'{_prefix}_duration_seconds_count{{{labels}}} {histogram.count}')
+            errors.append(f'{_prefix}_errors_total{{{labels}}} {histogram.errors}')
+        with open(_path, 'w', encoding='utf-8') as _file:
+            _file.write('\n'.join(lines + errors) + '\n')
+
+    @staticmethod
+    def _escape(_value:str):
+        return _value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+METRICS = Metrics()
+
+def _scpi_headers(_command):
+    # 'MEAS:RES? 100000,0.03, (@101)' -> 'MEAS:RES?', arguments would make every channel its own key
+    if isinstance(_command, bytes):
+        _command = _command.decode(errors='replace')
+    return ';'.join(part.strip().split(' ', 1)[0].lstrip(':') for part in _command.split(';'))
+
+def _dll_command(_name:str, _args:tuple):
+    # FeasaCom_Send(port, b'Getrgbi07', buf) -> 'FeasaCom_Send:Getrgbi', io_Update(b'dim16', 1) -> 'io_Update:dim16'
+    for arg in _args:
+        if isinstance(arg, bytes):
+            if _name.startswith('FeasaCom'):
+                # Trailing fiber number
+                arg = re.sub(rb'[0-9]+$', b'', arg)
+            return f"{_name}:{arg.decode(errors='replace')}"
+    return _name
+
+# Calls whose return value signals a failure count as errors even if nothing was raised
+_ERROR_RESULTS = {
+    'FeasaCom_Send': lambda result: result != 1,
+    'FeasaCom_Open': lambda result: result != 1,
+    'io_Update': lambda result: not result,
+    'io_Open': lambda result: not result,
+    'scan_serial_HW': lambda result: result is None,
+}
+
+class TimedFunction():
+    def __init__(self, _function, _metrics:Metrics, _device:str, _name:str):
+        self.function = _function
+        self.metrics = _metrics
+        self.device = _device
+        self.name = _name
+        self.is_error = _ERROR_RESULTS.get(_name)
+
+    def __call__(self, *args, **kwargs):
+        if not self.metrics.enabled:
+            return self.function(*args, **kwargs)
+        error = True
+        start = t.perf_counter()
+        try:
+            result = self.function(*args, **kwargs)
+            error = self.is_error is not None and self.is_error(result)
+            return result
+        finally:
+            self.metrics.record(self.device, _dll_command(self.name, args), t.perf_counter() - start, error)
+
+    def __getattr__(self, _name):
+        return getattr(self.function, _name)
+
+class TimedLibrary():
+    # Stands in for a ctypes library (IOCard.io); every io_* function is timed
+    def __init__(self, _library, _metrics:Metrics, _device:str):
+        object.__setattr__(self, '_library', _library)
+        object.__setattr__(self, '_metrics', _metrics)
+        object.__setattr__(self, '_device', _device)
+        object.__setattr__(self, '_functions', {})
+
+    def __getattr__(self, _name):
+        function = self._functions.get(_name)
+        if function is None:
+            function = self._functions[_name] = TimedFunction(getattr(self._library, _name), self._metrics, self._device, _name)
+        return function
+
+    def __setattr__(self, _name, _value):
+        setattr(self._library, _name, _value)
+
+class TimedResource():
+    # Stands in for a VISA resource/session
+    def __init__(self, _resource, _metrics:Metrics, _device:str):
+        object.__setattr__(self, '_resource', _resource)
+        object.__setattr__(self, '_metrics', _metrics)
+        object.__setattr__(self, '_device', _device)
+
+    def _timed(self, _function, _key, *args, **kwargs):
+        # Only called with the metrics enabled; _key is the command (turned into SCPI headers here) or the key itself
+        error = True
+        start = t.perf_counter()
+        try:
+            result = _function(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            self._metrics.record(self._device, _scpi_headers(_key), t.perf_counter() - start, error)
+
+    # Each entry point checks the flag first, so a disabled wrapper costs one attribute read per call
+    def write(self, _command, *args, **kwargs):
+        if not self._metrics.enabled:
+            return self._resource.write(_command, *args, **kwargs)
+        return self._timed(self._resource.write, _command, _command, *args, **kwargs)
+
+    def query(self, _command, *args, **kwargs):
+        if not self._metrics.enabled:
+            return self._resource.query(_command, *args, **kwargs)
+        return self._timed(self._resource.query, _command, _command, *args, **kwargs)
+
+    def write_raw(self, _message, *args, **kwargs):
+        if not self._metrics.enabled:
+            return self._resource.write_raw(_message, *args, **kwargs)
+        return self._timed(self._resource.write_raw, _message, _message, *args, **kwargs)
+
+    def query_binary_values(self, _command, *args, **kwargs):
+        if not self._metrics.enabled:
+            return self._resource.query_binary_values(_command, *args, **kwargs)
+        return self._timed(self._resource.query_binary_values, _command, _command, *args, **kwargs)
+
+    def read(self, *args, **kwargs):
+        if not self._metrics.enabled:
+            return self._resource.read(*args, **kwargs)
+        return self._timed(self._resource.read, 'read', *args, **kwargs)
+
+    def read_raw(self, *args, **kwargs):
+        if not self._metrics.enabled:
+            return self._resource.read_raw(*args, **kwargs)
+        return self._timed(self._resource.read_raw, 'read_raw', *args, **kwargs)
+
+    def __getattr__(self, _name):
+        return getattr(self._resource, _name)
+
+    def __setattr__(self, _name, _value):
+        setattr(self._resource, _name, _value)
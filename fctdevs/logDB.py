@@ -0,0 +1,236 @@
+from contextlib import contextmanager
+from datetime import datetime
+import csv
+import json
+import os
+import re
+import sqlite3
+import threading
+
+class logDB():
+    # Same header/escribirLog style as logFile, backed by an indexed SQLite database
+    CAMPOS_SERIAL = ('serial','sn','serial_number','numero_serie')
+    CAMPOS_RESULTADO = ('resultado','result','status','estado')
+    CAMPOS_FECHA = ('fecha','date','timestamp','datetime')
+    CAMPOS_HORA = ('hora','time')
+    # fecha is always stored in FORMATO_FECHA so the range filters and ORDER BY compare correctly
+    FORMATO_FECHA = "%Y-%m-%d %H:%M:%S"
+    FORMATOS_FECHA = ("%Y-%m-%d %H:%M:%S","%Y-%m-%d","%d/%m/%Y %H:%M:%S","%d/%m/%Y %H:%M","%d/%m/%Y","%Y/%m/%d %H:%M:%S","%Y/%m/%d","%Y%m%d%H%M%S","%Y%m%d")
+    FORMATOS_HORA = ("%H:%M:%S","%H:%M:%S.%f","%H:%M","%H%M%S")
+    def __init__(self,_ruta_db,_header,_estacion='',_campo_serial=None,_campo_resultado=None,_campo_fecha=None,_filas_buffer=1,_campo_hora=None):
+        self.ruta_db = _ruta_db
+        self.header = list(_header)
+        self.numeroElementos = len(self.header)
+        self.estacion = _estacion
+        self.campos = self._buscarCampos(self.header,_campo_serial,_campo_resultado,_campo_fecha,_campo_hora)
+        self.filas_buffer = max(1,_filas_buffer)
+        self.pendientes = []
+        self.en_tablero = False
+        self.lock = threading.RLock()
+        self.conexion = sqlite3.connect(self.ruta_db,check_same_thread=False)
+        self.conexion.execute("PRAGMA journal_mode=WAL")
+        self.conexion.execute("PRAGMA synchronous=NORMAL")
+        with self.conexion:
+            self.conexion.execute("""CREATE TABLE IF NOT EXISTS resultados (
+                id INTEGER PRIMARY KEY,
+                serial TEXT,
+                estacion TEXT,
+                fecha TEXT,
+                resultado INTEGER,
+                datos TEXT)""")
+            self.conexion.execute("CREATE INDEX IF NOT EXISTS idx_resultados_serial ON resultados(serial)")
+            self.conexion.execute("CREATE INDEX IF NOT EXISTS idx_resultados_fecha ON resultados(fecha)")
+            self.conexion.execute("CREATE INDEX IF NOT EXISTS idx_resultados_estacion ON resultados(estacion,fecha)")
+            self.conexion.execute("CREATE INDEX IF NOT EXISTS idx_resultados_resultado ON resultados(resultado,fecha)")
+            # How far each CSV has been imported, so importarCSV() only adds the rows appended since
+            self.conexion.execute("""CREATE TABLE IF NOT EXISTS importados (
+                archivo TEXT PRIMARY KEY,
+                posicion INTEGER,
+                filas INTEGER)""")
+
+    @classmethod
+    def _buscarCampos(cls,_header,_serial=None,_resultado=None,_fecha=None,_hora=None):
+        # Index of the serial, result, date and time columns, guessed from the header names when not given
+        nombres = [f"{campo}".strip().lower() for campo in _header]
+        def indice(_campo,_candidatos):
+            if _campo is not None:
+                return list(_header).index(_campo)
+            for candidato in _candidatos:
+                if candidato in nombres:
+                    return nombres.index(candidato)
+            return None
+        return (indice(_serial,cls.CAMPOS_SERIAL),indice(_resultado,cls.CAMPOS_RESULTADO),
+                indice(_fecha,cls.CAMPOS_FECHA),indice(_hora,cls.CAMPOS_HORA))
+
+    @staticmethod
+    def _resultado(_valor):
+        if isinstance(_valor,bool):
+            return int(_valor)
+        valor = f"{_valor}".strip().upper()
+        if valor in ('OK','PASS','P','TRUE','1','GOOD'):
+            return 1
+        if valor in ('NG','FAIL','F','FALSE','0','BAD'):
+            return 0
+        return None
+
+    @staticmethod
+    def _leerFecha(_valor,_formatos,_iso=True):
+        if isinstance(_valor,datetime):
+            return _valor
+        texto = f"{_valor}".strip()
+        if _iso:
+            try:
+                return datetime.fromisoformat(texto)
+            except ValueError:
+                pass
+        for formato in _formatos:
+            try:
+                return datetime.strptime(texto,formato)
+            except ValueError:
+                pass
+        return None
+
+    def _fecha(self,_log,_fecha,_hora,_defecto:datetime):
+        # Date and time columns are combined when both exist; what can't be parsed falls back to _defecto
+        fecha = None if _fecha is None else self._leerFecha(_log[_fecha],self.FORMATOS_FECHA)
+        hora = None if _hora is None else self._leerFecha(_log[_hora],self.FORMATOS_HORA,False)
+        if fecha is None:
+            fecha = _defecto
+        if hora is not None:
+            fecha = datetime.combine(fecha.date(),hora.time())
+        return fecha.strftime(self.FORMATO_FECHA)
+
+    def _fila(self,_header,_campos,_log,_estacion,_fecha_defecto:datetime=None):
+        serial, resultado, fecha, hora = _campos
+        return (
+            None if serial is None else f"{_log[serial]}",
+            _estacion,
+            self._fecha(_log,fecha,hora,_fecha_defecto or datetime.now()),
+            None if resultado is None else self._resultado(_log[resultado]),
+            json.dumps({f"{campo}":valor for campo,valor in zip(_header,_log)},default=str))
+
+    def escribirLog(self,_log):
+        if len(_log) != self.numeroElementos:
+            print("El log a escribir no coincide con el número de elementos")
+            return
+        with self.lock:
+            self.pendientes.append(self._fila(self.header,self.campos,_log,self.estacion))
+            if not self.en_tablero and len(self.pendientes) >= self.filas_buffer:
+                self.guardar()
+
+    @contextmanager
+    def tablero(self):
+        # with db.tablero(): escribirLog(...) x N -> one transaction for the whole board
+        with self.lock:
+            self.en_tablero = True
+            try:
+                yield self
+            finally:
+                self.en_tablero = False
+                self.guardar()
+
+    def guardar(self):
+        with self.lock:
+            pendientes, self.pendientes = self.pendientes, []
+            if pendientes:
+                self._insertar(pendientes)
+
+    def _insertar(self,_filas):
+        with self.lock, self.conexion:
+            self._insertarFilas(_filas)
+
+    def _insertarFilas(self,_filas):
+        self.conexion.executemany(
+            "INSERT INTO resultados (serial,estacion,fecha,resultado,datos) VALUES (?,?,?,?,?)",_filas)
+
+    def consultar(self,_serial=None,_estacion=None,_desde=None,_hasta=None,_resultado=None,_lote:int=500):
+        # Yields the logged rows as dicts, lazily, oldest first
+        condiciones, parametros = [], []
+        for columna,operador,valor in (('serial','=',_serial),('estacion','=',_estacion),('fecha','>=',_desde),('fecha','<',_hasta),('resultado','=',_resultado)):
+            if valor is None:
+                continue
+            if isinstance(valor,datetime):
+                valor = valor.strftime(self.FORMATO_FECHA)
+            if isinstance(valor,bool):
+                valor = int(valor)
+            condiciones.append(f"{columna} {operador} ?")
+            parametros.append(valor)
+        sql = "SELECT datos FROM resultados"
+        if condiciones:
+            sql += " WHERE " + " AND ".join(condiciones)
+        sql += " ORDER BY fecha, id"
+        # Own connection so a slow consumer doesn't hold the writer; WAL lets both run at once
+        conexion = sqlite3.connect(self.ruta_db)
+        try:
+            cursor = conexion.execute(sql,parametros)
+            while True:
+                filas = cursor.fetchmany(_lote)
+                if not filas:
+                    break
+                for (datos,) in filas:
+                    yield json.loads(datos)
+        finally:
+            conexion.close()
+
+    def rendimiento(self,_estacion=None,_desde=None,_hasta=None):
+        # (total, passed, yield) over the rows with a known result
+        condiciones, parametros = ["resultado IS NOT NULL"], []
+        for columna,operador,valor in (('estacion','=',_estacion),('fecha','>=',_desde),('fecha','<',_hasta)):
+            if valor is not None:
+                condiciones.append(f"{columna} {operador} ?")
+                parametros.append(valor.strftime(self.FORMATO_FECHA) if isinstance(valor,datetime) else valor)
+        with self.lock:
+            total, pasados = self.conexion.execute(
+                "SELECT COUNT(*), COALESCE(SUM(resultado),0) FROM resultados WHERE " + " AND ".join(condiciones),parametros).fetchone()
+        return total, pasados, (pasados / total if total else None)
+
+    def importarCSV(self,_ruta_csv,_estacion=None,_lote:int=5000):
+        # Ingests a tab separated file written by logFile; rows without a date column get the file's date.
+        # Importing the same file again only adds the complete rows appended since the last import.
+        estacion = self.estacion if _estacion is None else _estacion
+        archivo = os.path.realpath(_ruta_csv)
+        fecha = re.search(r"\d{4}-\d{2}-\d{2}",os.path.basename(_ruta_csv))
+        fecha_defecto = datetime.strptime(fecha.group(0),"%Y-%m-%d") if fecha else datetime.fromtimestamp(os.path.getmtime(_ruta_csv))
+        total = 0
+        with open(_ruta_csv,'rb') as _file, self.lock, self.conexion:
+            linea = _file.readline()
+            if not linea.endswith(b"\n"):
+                return 0
+            header = next(csv.reader([linea.decode('utf-8','replace')],delimiter='\t'))
+            campos = self._buscarCampos(header)
+            importado = self.conexion.execute("SELECT posicion FROM importados WHERE archivo = ?",(archivo,)).fetchone()
+            posicion = len(linea)
+            # A file shorter than what was imported was replaced: start over
+            if importado is not None and len(linea) <= importado[0] <= os.fstat(_file.fileno()).st_size:
+                posicion = importado[0]
+                _file.seek(posicion)
+            def lineas():
+                nonlocal posicion
+                for linea in _file:
+                    # A row still being written is left for the next import
+                    if not linea.endswith(b"\n"):
+                        break
+                    posicion += len(linea)
+                    yield linea.decode('utf-8','replace')
+            filas = []
+            for log in csv.reader(lineas(),delimiter='\t'):
+                if len(log) != len(header):
+                    continue
+                filas.append(self._fila(header,campos,log,estacion,fecha_defecto))
+                if len(filas) >= _lote:
+                    self._insertarFilas(filas)
+                    total += len(filas)
+                    filas = []
+            if filas:
+                self._insertarFilas(filas)
+                total += len(filas)
+            # Same transaction as the rows, so an interrupted import is neither lost nor doubled
+            self.conexion.execute("""INSERT INTO importados (archivo,posicion,filas) VALUES (?,?,?)
+                ON CONFLICT(archivo) DO UPDATE SET posicion = excluded.posicion, filas = filas + excluded.filas""",
+                (archivo,posicion,total))
+        return total
+
+    def cerrar(self):
+        with self.lock:
+            self.guardar()
+            self.conexion.close()
@@ -1,45 +1,137 @@
 from datetime import datetime
 import os
+import queue
+import threading
+import time
 
 class logFile():
-    def __init__(self,_ruta,_nombreArchivo,_header,_space_date=True):
+    def __init__(self,_ruta,_nombreArchivo,_header,_space_date=True,_filas_buffer=1,_intervalo_flush=0.0,_background=False):
         self.ruta = _ruta
-        if _space_date:
-            self.nombreArchivo = _nombreArchivo + " " + datetime.now().strftime("%Y-%m-%d") + ".csv"
-        else:
-            self.nombreArchivo = _nombreArchivo + datetime.now().strftime("%Y-%m-%d") + ".csv"
+        self.prefijo = _nombreArchivo + (" " if _space_date else "")
         self.header = _header
         self.numeroElementos = len(self.header)
-        if not self.buscarLogFile():
-            self.fh = open(self.ruta+"/"+self.nombreArchivo,"w")
+        # Rows are written to disk every _filas_buffer rows or every _intervalo_flush seconds, whatever comes first;
+        # _intervalo_flush <= 0 means no time limit, only the row count
+        self.filas_buffer = max(1,_filas_buffer)
+        self.intervalo_flush = _intervalo_flush
+        self.buffer = []
+        self.ultimo_flush = time.monotonic()
+        self.fh = None
+        self.fecha = None
+        self.lock = threading.RLock()
+        self.abrirArchivo()
+        self.cola = None
+        self.hilo = None
+        # Last write error of the background writer, raised by the next escribirLog()/guardar()
+        self.error = None
+        if _background:
+            self.cola = queue.Queue()
+            self.hilo = threading.Thread(target=self._escritor,name="logFile",daemon=True)
+            self.hilo.start()
+
+    def abrirArchivo(self):
+        self.fecha = datetime.now().strftime("%Y-%m-%d")
+        self.nombreArchivo = self.prefijo + self.fecha + ".csv"
+        existe = self.buscarLogFile()
+        self.fh = open(self.ruta+"/"+self.nombreArchivo,"a")
+        if not existe:
             self.crearHeader()
-            self.cerrar()
-            
+            self.fh.flush()
+
     def buscarLogFile(self):
-        if self.nombreArchivo in os.listdir(self.ruta):
+        if os.path.isfile(self.ruta+"/"+self.nombreArchivo):
             print("Ya existe un registro el dia de hoy")
             return True
         else:
             print("Creando un nuevo registro el dia de hoy")
             return False
+
     def crearHeader(self):
-        for i in range(0,self.numeroElementos):
-            if i == self.numeroElementos - 1:
-                self.fh.write(f"{self.header[i]}\n")
-            else:
-                self.fh.write(f"{self.header[i]}\t")   
-                
+        self.fh.write("\t".join(f"{campo}" for campo in self.header) + "\n")
+
     def escribirLog(self,_log):
-        self.fh = open(self.ruta+"/"+self.nombreArchivo,"a")
-        if len(_log) == self.numeroElementos:
-            for i in range(0,self.numeroElementos):
-                if i == self.numeroElementos - 1:
-                    self.fh.write(f"{_log[i]}\n")
+        if len(_log) != self.numeroElementos:
+            print("El log a escribir no coincide con el número de elementos")
+            return
+        fila = "\t".join(f"{campo}" for campo in _log) + "\n"
+        if self.cola is not None:
+            self._lanzarError()
+            self.cola.put(fila)
+        else:
+            self._agregar(fila)
+
+    def _agregar(self,_fila):
+        with self.lock:
+            self.buffer.append(_fila)
+            if len(self.buffer) >= self.filas_buffer or (self.intervalo_flush > 0 and time.monotonic() - self.ultimo_flush >= self.intervalo_flush):
+                self._vaciar()
+
+    def _vaciar(self):
+        # The date is checked on every flush so the file rolls over at midnight
+        with self.lock:
+            if self.fh.closed:
+                self.abrirArchivo()
+            elif datetime.now().strftime("%Y-%m-%d") != self.fecha:
+                self.fh.close()
+                self.abrirArchivo()
+            if self.buffer:
+                self.fh.write("".join(self.buffer))
+                self.buffer = []
+            self.fh.flush()
+            self.ultimo_flush = time.monotonic()
+
+    def _escritor(self):
+        # A failed write keeps the rows in the buffer for the next flush and leaves the error for the caller
+        while True:
+            try:
+                fila = self.cola.get(timeout=self.intervalo_flush if self.intervalo_flush > 0 else None)
+            except queue.Empty:
+                try:
+                    with self.lock:
+                        if self.buffer:
+                            self._vaciar()
+                except Exception as e:
+                    self.error = e
+                continue
+            if fila is None:
+                self.cola.task_done()
+                break
+            try:
+                if isinstance(fila,threading.Event):
+                    self._vaciar()
                 else:
-                    self.fh.write(f"{_log[i]}\t")
+                    self._agregar(fila)
+            except Exception as e:
+                self.error = e
+            finally:
+                if isinstance(fila,threading.Event):
+                    fila.set()
+                self.cola.task_done()
+
+    def _lanzarError(self):
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def guardar(self):
+        # Explicit commit: everything written so far is on disk when this returns, otherwise it raises
+        if self.hilo is not None:
+            listo = threading.Event()
+            self.cola.put(listo)
+            while not listo.wait(0.5):
+                if not self.hilo.is_alive():
+                    raise RuntimeError("logFile writer thread is not running")
+            self._lanzarError()
         else:
-            print("El log a escribir no coincide con el número de elementos")
-        self.cerrar()
-                
+            self._vaciar()
+
     def cerrar(self):
-        self.fh.close()
\ No newline at end of file
+        if self.hilo is not None:
+            self.cola.put(None)
+            self.hilo.join()
+            self.hilo = None
+            self.cola = None
+        with self.lock:
+            if self.fh is not None and not self.fh.closed:
+                self._vaciar()
+                self.fh.close()
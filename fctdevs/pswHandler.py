@@ -1,45 +1,141 @@
+from collections import namedtuple
+import hashlib
+import hmac
 import json
+import os
+import struct
+import threading
+import time as t
+
+# Parsed credentials, replaced as a whole on reload so a validation never sees a half loaded file.
+# psw and users hold keyed digests, the plaintext is not kept.
+_Snapshot = namedtuple('_Snapshot', ['mtime_ns', 'size', 'max_fails', 'salt', 'psw', 'users'])
 
 class pswHandler():
     PSW_NO_READ_FLAG = -1
     PSW_USER_FLAG = 0
     PSW_PSW_FLAG = 1
-    def __init__(self,_psw_file:str):
+    DIGEST_SIZE = 16
+    # Binary cache: header (magic, file mtime_ns, file size, max_fails, salt, psw digest, user count) + user digests
+    CACHE_MAGIC = b'PSW1'
+    CACHE_HEADER = struct.Struct('<4sQQI16s16sI')
+    def __init__(self,_psw_file:str,_reload_interval:float=2.0,_cache_file:str=None):
+        # The file is checked for changes at most every _reload_interval seconds, from validatePSW()
         self.psw_file = _psw_file
+        self.reload_interval = _reload_interval
+        self.cache_file = _cache_file
         self.last_user_to_validate = "UNDEFINED"
         self.state = False
+        self.snapshot = None
+        self.next_check = 0.0
+        self.reload_lock = threading.Lock()
+        self.reloader = None
         self.getPSW()
 
+    @property
+    def max_fails(self):
+        snapshot = self.snapshot
+        return None if snapshot is None else snapshot.max_fails
+
     def getPSW(self):
+        # Loads the file now; if it can't be read the credentials loaded before stay in use
         try:
-            with open(self.psw_file,'r',encoding = 'utf-8') as _file:
-                _data = json.load(_file)
-                self.psw = _data["psw"]
-                self.users = _data["users"]
-                self.max_fails = _data["max_fails"]
-                self.state = True
-        except:
-            self.state = False
+            stat = os.stat(self.psw_file)
+            snapshot = self._load_cache(stat)
+            if snapshot is None:
+                snapshot = self._parse(stat)
+                self._save_cache(snapshot)
+            self.snapshot = snapshot
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self.state = self.snapshot is not None
+        self.next_check = t.monotonic() + self.reload_interval
         return self.state
-    
+
+    @classmethod
+    def _digest(cls,_salt:bytes,_value):
+        return hashlib.blake2b(str(_value).encode('utf-8'),key=_salt,digest_size=cls.DIGEST_SIZE).digest()
+
+    def _parse(self,_stat):
+        with open(self.psw_file,'r',encoding = 'utf-8') as _file:
+            _data = json.load(_file)
+        salt = os.urandom(self.DIGEST_SIZE)
+        users = frozenset(self._digest(salt,user) for user in _data["users"])
+        return _Snapshot(_stat.st_mtime_ns,_stat.st_size,int(_data["max_fails"]),salt,self._digest(salt,_data["psw"]),users)
+
+    def _load_cache(self,_stat):
+        # Only used while it matches the mtime and size of the JSON file
+        if self.cache_file is None:
+            return None
+        try:
+            with open(self.cache_file,'rb') as _file:
+                data = _file.read()
+        except OSError:
+            return None
+        header = self.CACHE_HEADER
+        if len(data) < header.size:
+            return None
+        magic, mtime_ns, size, max_fails, salt, psw, count = header.unpack_from(data)
+        if magic != self.CACHE_MAGIC or (mtime_ns,size) != (_stat.st_mtime_ns,_stat.st_size) or len(data) != header.size + count*self.DIGEST_SIZE:
+            return None
+        users = frozenset(data[i:i+self.DIGEST_SIZE] for i in range(header.size,len(data),self.DIGEST_SIZE))
+        return _Snapshot(mtime_ns,size,max_fails,salt,psw,users)
+
+    def _save_cache(self,_snapshot:_Snapshot):
+        if self.cache_file is None:
+            return
+        temp = f'{self.cache_file}.{os.getpid()}.tmp'
+        try:
+            header = self.CACHE_HEADER.pack(self.CACHE_MAGIC,_snapshot.mtime_ns,_snapshot.size,_snapshot.max_fails,
+                                            _snapshot.salt,_snapshot.psw,len(_snapshot.users))
+            with open(temp,'wb') as _file:
+                _file.write(header + b''.join(sorted(_snapshot.users)))
+            os.replace(temp,self.cache_file)
+        except (OSError, struct.error):
+            pass
+
+    def _check_reload(self):
+        # One stat() per interval; a changed file is parsed on a background thread while
+        # validations keep using the current snapshot
+        now = t.monotonic()
+        if now < self.next_check:
+            return
+        self.next_check = now + self.reload_interval
+        try:
+            stat = os.stat(self.psw_file)
+        except OSError:
+            return
+        snapshot = self.snapshot
+        if snapshot is not None and (stat.st_mtime_ns,stat.st_size) == (snapshot.mtime_ns,snapshot.size):
+            return
+        with self.reload_lock:
+            if self.reloader is None or not self.reloader.is_alive():
+                self.reloader = threading.Thread(target=self.getPSW,name="pswReload",daemon=True)
+                self.reloader.start()
+
+    def _pswType(self,_snapshot:_Snapshot,_last_fails_count:int):
+        if _snapshot is None:
+            return self.PSW_NO_READ_FLAG
+        if _last_fails_count >= _snapshot.max_fails:
+            return self.PSW_USER_FLAG
+        return self.PSW_PSW_FLAG
+
     def getPSWType(self,_last_fails_count:int):
-        if self.state:
-            if _last_fails_count >= self.max_fails:
-                self.psw_type = self.PSW_USER_FLAG
-            else:
-                self.psw_type = self.PSW_PSW_FLAG
-        else:
-            self.psw_type = self.PSW_NO_READ_FLAG
+        self.psw_type = self._pswType(self.snapshot,_last_fails_count)
         return self.psw_type
 
 
     def validatePSW(self,_last_fails_count:int,_psw:str):
-        self.getPSWType(_last_fails_count)
-        if self.psw_type == self.PSW_USER_FLAG:
-            res_flag = _psw in self.users
+        self._check_reload()
+        # Type, max_fails and digests all come from one snapshot, a reload can swap it at any time
+        snapshot = self.snapshot
+        psw_type = self.psw_type = self._pswType(snapshot,_last_fails_count)
+        res_flag = False
+        if psw_type == self.PSW_USER_FLAG:
+            # Keyed digests: the set lookup time says nothing about the stored badges
+            res_flag = self._digest(snapshot.salt,_psw) in snapshot.users
             if res_flag:
                 self.last_user_to_validate = _psw
-        elif self.psw_type == self.PSW_PSW_FLAG:
-            res_flag = _psw == self.psw
+        elif psw_type == self.PSW_PSW_FLAG:
+            res_flag = hmac.compare_digest(self._digest(snapshot.salt,_psw),snapshot.psw)
         return res_flag
-
@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import time as t
+
+class Step():
+    PENDING = "PENDING"
+    DONE = "DONE"
+    FAILED = "FAILED"
+    SKIPPED = "SKIPPED"
+    def __init__(self, _name:str, _func, _devices=(), _depends=()):
+        self.name = _name
+        self.func = _func
+        self.devices = tuple(_devices)
+        self.depends = tuple(_depends)
+        self.reset()
+
+    def reset(self):
+        self.state = self.PENDING
+        self.result = None
+        self.error = None
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+    def shares_device(self, _step):
+        return any(device is other for device in self.devices for other in _step.devices)
+
+class StepScheduler():
+    # Runs steps on a thread pool; steps using the same device never overlap, everything else may
+    def __init__(self, _max_workers:int=8):
+        self.max_workers = _max_workers
+        self.steps = {}
+        # id(device) -> (device, lock); the device is kept so its id can't be reused
+        self.locks = {}
+        self.start = None
+        self.end = None
+
+    def add(self, _name:str, _func, _devices=(), _depends=()):
+        # _func() takes no arguments; its return value ends up in Step.result
+        if _name in self.steps:
+            raise ValueError(f"Duplicated step name: {_name}")
+        step = Step(_name, _func, _devices, _depends)
+        self.steps[_name] = step
+        return step
+
+    def _device_lock(self, _device):
+        # Devices with their own lock (DAQ, IOCard) are shared with code running outside the scheduler
+        lock = getattr(_device, 'lock', None)
+        if lock is None:
+            lock = threading.Lock()
+        return self.locks.setdefault(id(_device), (_device, lock))[1]
+
+    def _run_step(self, _step:Step):
+        # Locks are always taken in the same order so two steps can't deadlock each other
+        locks = [lock for _key, lock in sorted({id(device): self._device_lock(device) for device in _step.devices}.items())]
+        for lock in locks:
+            lock.acquire()
+        try:
+            _step.start = t.monotonic()
+            _step.result = _step.func()
+            _step.state = Step.DONE
+        except Exception as e:
+            _step.error = e
+            _step.state = Step.FAILED
+        finally:
+            _step.end = t.monotonic()
+            for lock in reversed(locks):
+                lock.release()
+
+    def run(self):
+        # Returns {name: result}; failed steps have Step.error set and their dependents are SKIPPED
+        for step in self.steps.values():
+            for depend in step.depends:
+                if depend not in self.steps:
+                    raise ValueError(f"Step {step.name} depends on unknown step {depend}")
+            step.reset()
+        pending = list(self.steps.values())
+        running = {}
+        self.start = t.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                changed = True
+                while changed:
+                    changed = False
+                    for step in list(pending):
+                        states = [self.steps[depend].state for depend in step.depends]
+                        if Step.FAILED in states or Step.SKIPPED in states:
+                            step.state = Step.SKIPPED
+                        elif all(state == Step.DONE for state in states):
+                            running[pool.submit(self._run_step, step)] = step
+                        else:
+                            continue
+                        pending.remove(step)
+                        changed = True
+                if not running:
+                    if pending:
+                        raise ValueError(f"Dependency cycle between steps: {[step.name for step in pending]}")
+                    break
+                done, _not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.pop(future)
+                    future.result()
+        self.end = t.monotonic()
+        return {name: step.result for name, step in self.steps.items()}
+
+    def critical_path(self):
+        # Walks back from the last step to finish, each time to the dependency or device sharer
+        # that released it last; returns (step names, seconds from its first start to the end)
+        finished = [step for step in self.steps.values() if step.end is not None]
+        if not finished:
+            return [], 0.0
+        step = max(finished, key=lambda s: s.end)
+        path = [step]
+        while True:
+            blockers = [self.steps[depend] for depend in step.depends]
+            blockers += [other for other in finished if other is not step and other.shares_device(step)]
+            blockers = [other for other in blockers if other.end is not None and other.end <= step.start and other not in path]
+            if not blockers:
+                break
+            step = max(blockers, key=lambda s: s.end)
+            path.append(step)
+        path.reverse()
+        return [step.name for step in path], path[-1].end - path[0].start
+
+    def report(self):
+        # One line per step: name, state, start offset and duration in ms, '*' on the critical path
+        critical, total = self.critical_path()
+        lines = []
+        for step in sorted(self.steps.values(), key=lambda s: (s.start is None, s.start)):
+            start = '-' if step.start is None else f"{(step.start - self.start) * 1000:.1f}"
+            duration = '-' if step.duration is None else f"{step.duration * 1000:.1f}"
+            mark = '*' if step.name in critical else ' '
+            lines.append(f"{mark}{step.name}\t{step.state}\t{start}\t{duration}")
+        lines.append(f"Critical path: {' -> '.join(critical)} ({total * 1000:.1f} ms)")
+        return lines
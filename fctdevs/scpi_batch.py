@@ -0,0 +1,210 @@
+class BatchResult():
+    def __init__(self, _command:str, _parser=str):
+        self.command = _command
+        self.parser = _parser
+        self.done = False
+        self.value = None
+        self.error = None
+
+    def set(self, _reply:str):
+        try:
+            self.value = self.parser(_reply)
+        except Exception as e:
+            self.error = f"Cannot parse reply {_reply!r}: {e}"
+        self.done = True
+
+    def fail(self, _error):
+        self.error = _error
+        self.done = True
+
+    def result(self):
+        if not self.done:
+            raise RuntimeError(f"Batch not flushed yet: {self.command}")
+        return self.value
+
+class _BatchedInstrument():
+    # Stands in for the VISA resource while a batch is open: writes are queued, any other I/O flushes first
+    # so it reaches the instrument after the commands queued before it
+    def __init__(self, _batch, _instrument):
+        object.__setattr__(self, '_batch', _batch)
+        object.__setattr__(self, '_instrument', _instrument)
+
+    def write(self, _command:str):
+        self._batch.write(_command)
+
+    def query(self, _command:str, *args, **kwargs):
+        self._batch.flush()
+        return self._instrument.query(_command, *args, **kwargs)
+
+    def read(self, *args, **kwargs):
+        self._batch.flush()
+        return self._instrument.read(*args, **kwargs)
+
+    def read_raw(self, *args, **kwargs):
+        self._batch.flush()
+        return self._instrument.read_raw(*args, **kwargs)
+
+    def write_raw(self, _message, *args, **kwargs):
+        self._batch.flush()
+        return self._instrument.write_raw(_message, *args, **kwargs)
+
+    def query_binary_values(self, _command:str, *args, **kwargs):
+        self._batch.flush()
+        return self._instrument.query_binary_values(_command, *args, **kwargs)
+
+    def query_ascii_values(self, _command:str, *args, **kwargs):
+        self._batch.flush()
+        return self._instrument.query_ascii_values(_command, *args, **kwargs)
+
+    def __getattr__(self, _name):
+        return getattr(self._instrument, _name)
+
+    def __setattr__(self, _name, _value):
+        # e.g. timeout, which has to change on the real session
+        setattr(self._instrument, _name, _value)
+
+class SCPIBatch():
+    NO_ERROR = 0
+    ERROR_QUERY = ':SYST:ERR?'
+    def __init__(self, _device, _check_errors:bool=True, _max_length:int=512):
+        self.device = _device
+        self.check_errors = _check_errors
+        self.max_length = _max_length
+        self.instrument = None
+        self.pending = []
+        self.errors = []
+        self.nested = False
+
+    def __enter__(self):
+        self.instrument = self.device.instrument
+        # Nested batches just keep queuing on the outer one
+        self.nested = isinstance(self.instrument, _BatchedInstrument)
+        if not self.nested:
+            self.device.instrument = _BatchedInstrument(self, self.instrument)
+        return self
+
+    def __exit__(self, _exc_type, _exc, _tb):
+        if self.nested:
+            return False
+        self.device.instrument = self.instrument
+        if _exc_type is None:
+            self.flush()
+        else:
+            for _command, result in self.pending:
+                if result is not None:
+                    result.fail("Batch aborted")
+            self.pending = []
+        return False
+
+    def write(self, _command:str):
+        if self.nested:
+            return self.instrument.write(_command)
+        self.pending.append((_command, None))
+
+    def query(self, _command:str, _parser=str):
+        if self.nested:
+            return self.instrument._batch.query(_command, _parser)
+        result = BatchResult(_command, _parser)
+        self.pending.append((_command, result))
+        return result
+
+    def flush(self):
+        # Returns the (command, code, message) errors reported by the instrument for this flush
+        pending, self.pending = self.pending, []
+        errors = []
+        chunk, length = [], 0
+        try:
+            for item in pending:
+                size = len(item[0]) + 2 + (len(self.ERROR_QUERY) + 1 if self.check_errors else 0)
+                if chunk and length + size > self.max_length:
+                    errors += self._send(chunk)
+                    chunk, length = [], 0
+                chunk.append(item)
+                length += size
+            if chunk:
+                errors += self._send(chunk)
+        except Exception:
+            self._invalidate()
+            raise
+        if errors:
+            self._invalidate()
+        self.errors += errors
+        return errors
+
+    def _invalidate(self):
+        # The device caches state when a command is queued, not when it is sent, so after a failed
+        # flush that state can't be trusted; devices with a cache expose invalidate_config()
+        invalidate = getattr(self.device, 'invalidate_config', None)
+        if invalidate is not None:
+            invalidate()
+
+    def _send(self, _chunk:list):
+        parts = []
+        for command, _result in _chunk:
+            parts.append(command if command.startswith((':', '*')) else ':' + command)
+            # One error queue read right after each command attributes errors per command
+            if self.check_errors:
+                parts.append(self.ERROR_QUERY)
+        message = ';'.join(parts)
+        expected = sum(result is not None for _command, result in _chunk)
+        if self.check_errors:
+            expected += len(_chunk)
+        if expected == 0:
+            self.instrument.write(message)
+            return []
+        replies = self.split_reply(self.instrument.query(message))
+        if len(replies) != expected:
+            return self._mismatch(_chunk, replies)
+        errors = []
+        replies = iter(replies)
+        for command, result in _chunk:
+            if result is not None:
+                result.set(next(replies))
+            if self.check_errors:
+                code, text = self.parse_error(next(replies))
+                if code != self.NO_ERROR:
+                    errors.append((command, code, text))
+                    if result is not None:
+                        result.error = f"{code},{text}"
+        return errors
+
+    def _mismatch(self, _chunk:list, _replies:list):
+        # A failing query usually produces no reply, so the replies can't be matched to commands anymore
+        error = f"Expected one reply per query, got {len(_replies)}"
+        for _command, result in _chunk:
+            if result is not None:
+                result.fail(error)
+        errors = [(None, None, error)]
+        if self.check_errors:
+            for _i in range(32):
+                code, text = self.parse_error(self.instrument.query(self.ERROR_QUERY))
+                if code == self.NO_ERROR:
+                    break
+                errors.append((None, code, text))
+        return errors
+
+    @staticmethod
+    def parse_error(_reply:str):
+        code, _sep, text = _reply.strip().partition(',')
+        try:
+            return int(code), text.strip('"')
+        except ValueError:
+            return None, _reply.strip()
+
+    @staticmethod
+    def split_reply(_reply:str):
+        # Splits on ';' outside of quoted strings
+        replies, current, quote = [], [], None
+        for char in _reply.strip():
+            if quote is not None:
+                if char == quote:
+                    quote = None
+            elif char in '"\'':
+                quote = char
+            elif char == ';':
+                replies.append(''.join(current))
+                current = []
+                continue
+            current.append(char)
+        replies.append(''.join(current))
+        return replies
@@ -0,0 +1,273 @@
+from collections import Counter
+import random
+import re
+import struct
+import time as t
+
+class Script():
+    # Scripted replies: {regex: value}; a value can be a constant, a list (consumed in order, the last one sticks)
+    # or a callable(command) -> reply. The first matching rule wins.
+    def __init__(self, _rules:dict=None, _default=None):
+        self.rules = [(re.compile(pattern, re.IGNORECASE), value) for pattern, value in (_rules or {}).items()]
+        self.default = _default
+
+    def answer(self, _command:str):
+        for pattern, value in self.rules:
+            if pattern.search(_command):
+                if callable(value):
+                    return value(_command)
+                if isinstance(value, list):
+                    return value.pop(0) if len(value) > 1 else value[0]
+                return value
+        return self.default
+
+class Latency():
+    # Per-command latency in seconds: {regex: seconds}, uniform jitter of +-_jitter seconds on top
+    def __init__(self, _default:float=0.0, _jitter:float=0.0, _per_command:dict=None):
+        self.default = _default
+        self.jitter = _jitter
+        self.per_command = [(re.compile(pattern, re.IGNORECASE), seconds) for pattern, seconds in (_per_command or {}).items()]
+
+    def seconds(self, _command:str):
+        for pattern, seconds in self.per_command:
+            if pattern.search(_command):
+                break
+        else:
+            seconds = self.default
+        if self.jitter:
+            seconds += random.uniform(-self.jitter, self.jitter)
+        return max(0.0, seconds)
+
+    def wait(self, _command:str):
+        seconds = self.seconds(_command)
+        if seconds:
+            t.sleep(seconds)
+
+class _FakeFunction():
+    # Accepts argtypes/restype like a ctypes function and counts its calls
+    def __init__(self, _library, _name:str, _function):
+        self.library = _library
+        self.name = _name
+        self.function = _function
+        self.argtypes = None
+        self.restype = None
+
+    def __call__(self, *args):
+        self.library.calls[self.name] += 1
+        return self.function(*args)
+
+class FakeResource():
+    # Minimal SCPI instrument: tracks CONF/ROUT:SCAN/TRIG:COUN/FORM so DAQ scan, READ? and binary FETC? work
+    def __init__(self, _manager, _resource_name:str):
+        self.manager = _manager
+        self.resource_name = _resource_name
+        self.timeout = 2000
+        self.round_trips = 0
+        self.commands = Counter()
+        self.config = {}
+        self.scan = []
+        self.trigger_count = 1
+        self.binary = False
+        self.relays = {}
+        self.output = None
+        self.closed = False
+
+    @staticmethod
+    def channels(_text:str):
+        match = re.search(r'\(@([^)]*)\)', _text)
+        if match is None:
+            return []
+        channels = []
+        for item in match.group(1).split(','):
+            first, _sep, last = item.strip().partition(':')
+            channels += list(range(int(first), int(last or first) + 1))
+        return channels
+
+    def _reading(self, _channel:int):
+        function = self.config.get(_channel, 'VOLT:DC')
+        return float(self.manager.script.answer(f'MEAS:{function}? (@{_channel})') or 0)
+
+    def _unit(self, _unit:str):
+        unit = _unit.strip().lstrip(':')
+        header = unit.split(' ', 1)[0].upper()
+        self.commands[header] += 1
+        if header.startswith('CONF:'):
+            channels = self.channels(unit)
+            for channel in channels:
+                self.config[channel] = header[5:]
+            self.scan = channels
+        elif header == 'ROUT:SCAN':
+            self.scan = self.channels(unit)
+        elif header in ('ROUT:CLOSE', 'ROUT:OPEN'):
+            for channel in self.channels(unit):
+                self.relays[channel] = header == 'ROUT:CLOSE'
+        elif header.startswith('TRIG:COUN'):
+            self.trigger_count = int(float(unit.split(' ', 1)[1]))
+        elif header.startswith('FORM:DATA'):
+            self.binary = 'REAL' in unit.upper()
+        elif header.startswith('MEAS:') and '(@' in unit:
+            channels = self.channels(unit)
+            for channel in channels:
+                self.config[channel] = header[5:].rstrip('?')
+            self.scan = channels
+            return ','.join(f'{self._reading(channel):+.9E}' for channel in channels)
+        if '?' not in header:
+            return None
+        if header == 'SYST:ERR?':
+            return '+0,"No error"'
+        if header == '*OPC?':
+            return '1'
+        if header == '*IDN?':
+            return f'SIMULATED,{self.resource_name},0,1.0'
+        if header in ('READ?', 'FETC?', 'R?'):
+            readings = [self._reading(channel) for _i in range(self.trigger_count) for channel in self.scan]
+            if self.binary:
+                data = struct.pack(f'>{len(readings)}d', *readings)
+                length = str(len(data)).encode()
+                return b'#' + str(len(length)).encode() + length + data
+            return ','.join(f'{reading:+.9E}' for reading in readings)
+        reply = self.manager.script.answer(unit)
+        return '0' if reply is None else str(reply)
+
+    def write(self, _message:str):
+        self.round_trips += 1
+        self._send(_message)
+
+    def _send(self, _message:str):
+        self.manager.latency.wait(_message)
+        replies = [reply for reply in map(self._unit, _message.split(';')) if reply is not None]
+        if not replies:
+            self.output = None
+        elif len(replies) == 1:
+            self.output = replies[0]
+        else:
+            self.output = ';'.join(replies)
+
+    def write_raw(self, _message:bytes):
+        self.write(_message.decode().rstrip('\r\n'))
+
+    def read_raw(self):
+        output, self.output = self.output, None
+        if output is None:
+            raise TimeoutError(f"{self.resource_name}: nothing to read")
+        return output if isinstance(output, bytes) else (output + '\n').encode()
+
+    def read(self):
+        return self.read_raw().decode().rstrip('\r\n')
+
+    def query_binary_values(self, _message:str, datatype:str='f', is_big_endian:bool=False, container=list, **kwargs):
+        # IEEE 488.2 block, read by its declared length like pyvisa does
+        self.round_trips += 1
+        self._send(_message)
+        raw, self.output = self.output, None
+        if not isinstance(raw, bytes):
+            raise ValueError(f"{self.resource_name}: {_message} did not return a binary block")
+        digits = int(raw[1:2])
+        length = int(raw[2:2 + digits])
+        size = struct.calcsize(datatype)
+        values = struct.unpack(('>' if is_big_endian else '<') + f'{length // size}{datatype}', raw[2 + digits:2 + digits + length])
+        return container(values)
+
+    def query(self, _message:str):
+        # The reply comes back in the same round trip
+        self.round_trips += 1
+        self._send(_message)
+        return self.read()
+
+    def close(self):
+        self.closed = True
+
+class FakeResourceManager():
+    # Drop-in for pyvisa.ResourceManager(); latency is paid once per write/query round trip
+    def __init__(self, _latency:float=0.002, _jitter:float=0.0, _per_command:dict=None, _values:dict=None, _open_time:float=0.0):
+        self.latency = Latency(_latency, _jitter, _per_command)
+        self.script = Script(_values)
+        self.open_time = _open_time
+        self.resources = {}
+
+    def open_resource(self, _resource_name:str, **kwargs):
+        if self.open_time:
+            t.sleep(self.open_time)
+        resource = FakeResource(self, _resource_name)
+        self.resources[_resource_name] = resource
+        return resource
+
+    def list_resources(self):
+        return tuple(self.resources)
+
+    def round_trips(self):
+        return sum(resource.round_trips for resource in self.resources.values())
+
+class FakeFeasaDLL():
+    # Stands in for feasacom(64).dll: FEASA(..., _dll=FakeFeasaDLL())
+    def __init__(self, _fibers:int=20, _latency:float=0.004, _capture:float=0.05, _jitter:float=0.0, _values=None):
+        # _values(fiber) -> (r, g, b, intensity)
+        self.fibers = _fibers
+        self.latency = Latency(_latency, _jitter, {'^capture': _capture})
+        self.values = _values or (lambda fiber: (100 + fiber, 50, 25, 1000 * fiber))
+        self.calls = Counter()
+        self.timeout = None
+        self.functions = {
+            'FeasaCom_Open': _FakeFunction(self, 'FeasaCom_Open', lambda port, baudrate: 1),
+            'FeasaCom_Close': _FakeFunction(self, 'FeasaCom_Close', lambda port: 0),
+            'FeasaCom_Send': _FakeFunction(self, 'FeasaCom_Send', self._send),
+            'FeasaCom_EnumPorts': _FakeFunction(self, 'FeasaCom_EnumPorts', lambda: 1),
+            'FeasaCom_SetResponseTimeout': _FakeFunction(self, 'FeasaCom_SetResponseTimeout', self._set_timeout),
+        }
+
+    def __getitem__(self, _name:str):
+        return self.functions[_name]
+
+    def __getattr__(self, _name:str):
+        try:
+            return self.__dict__['functions'][_name]
+        except KeyError:
+            raise AttributeError(_name)
+
+    def _set_timeout(self, _timeout:int):
+        self.timeout = _timeout
+        return 1
+
+    def _line(self, _fiber:int):
+        r, g, b, i = self.values(_fiber)
+        return b'%03d %03d %03d %05d' % (r, g, b, i)
+
+    def _send(self, _port:int, _command:bytes, _buffer):
+        command = _command.decode().lower()
+        self.latency.wait(command)
+        if command == 'capture':
+            reply = b'OK'
+        elif command == 'getrgbiall':
+            reply = b'\n'.join(self._line(fiber) for fiber in range(1, self.fibers + 1))
+        elif command.startswith('getrgbi'):
+            reply = self._line(int(command[7:]))
+        elif command.startswith('getintensity'):
+            reply = b'%05d' % self.values(int(command[12:]))[3]
+        else:
+            return 0
+        _buffer.value = reply
+        return 1
+
+class FakeIOPortDLL():
+    # Stands in for ioportlib.dll: IOCard(_dll=FakeIOPortDLL())
+    def __init__(self, _update:float=0.008, _jitter:float=0.0, _inputs=None, _rgbim=None):
+        # _inputs(module, channel) -> bool, _rgbim(module, fiber, color) -> int
+        self.latency = Latency(_update, _jitter)
+        self.inputs = _inputs or (lambda module, channel: False)
+        self.rgbim = _rgbim or (lambda module, fiber, color: 100 * (color + 1) + fiber)
+        self.outputs = {}
+        self.calls = Counter()
+        for name, function in (('io_Err', lambda: b''), ('io_Open', lambda port: True), ('io_Close', lambda: None),
+                               ('io_dim16Val', lambda module, channel: bool(self.inputs(module, channel))),
+                               ('io_dom16Val', self._dom16),
+                               ('io_lim16Val', lambda module, channel: False),
+                               ('io_rgbimVal', lambda module, fiber, color: int(self.rgbim(module, fiber, color))),
+                               ('io_Update', self._update)):
+            setattr(self, name, _FakeFunction(self, name, function))
+
+    def _dom16(self, _module:int, _channel:int, _value:bool):
+        self.outputs[(_module, _channel)] = bool(_value)
+
+    def _update(self, _name:bytes, _module:int):
+        self.latency.wait(_name.decode())
+        return True
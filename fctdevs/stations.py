@@ -0,0 +1,164 @@
+import multiprocessing
+import queue
+import threading
+import time as t
+import traceback
+
+class StationContext():
+    # Given to the fixture function inside its worker process; everything goes back over one queue
+    def __init__(self, _name:str, _queue, _stop_event):
+        self.name = _name
+        self.queue = _queue
+        self.stop_event = _stop_event
+
+    def result(self, _result):
+        self.queue.put((self.name, StationRunner.MSG_RESULT, _result))
+
+    def log(self, _row, _sink:str='default'):
+        self.queue.put((self.name, StationRunner.MSG_LOG, (_sink, _row)))
+
+    def status(self, _status):
+        self.queue.put((self.name, StationRunner.MSG_STATUS, _status))
+
+    def stop_requested(self):
+        return self.stop_event.is_set()
+
+def _worker_main(_name:str, _target, _args:tuple, _queue, _stop_event):
+    context = StationContext(_name, _queue, _stop_event)
+    try:
+        _target(context, *_args)
+    except Exception:
+        _queue.put((_name, StationRunner.MSG_ERROR, traceback.format_exc()))
+        raise SystemExit(1)
+
+class Fixture():
+    # _target(context, *_args) runs in its own process and builds its own DAQ/PowerSource/IOCard/FEASA there.
+    # It has to be a module level function so it can be started with spawn (always the case on Windows).
+    def __init__(self, _name:str, _target, _args:tuple=()):
+        self.name = _name
+        self.target = _target
+        self.args = tuple(_args)
+
+class StationRunner():
+    MSG_RESULT = "result"
+    MSG_LOG = "log"
+    MSG_STATUS = "status"
+    MSG_ERROR = "error"
+    def __init__(self, _fixtures:list, _sinks:dict=None, _on_result=None, _on_status=None, _on_error=None, _max_restarts:int=5, _restart_delay:float=2.0):
+        # _sinks: {name: logFile/logDB-like object}; only this process writes to them.
+        # _on_result(fixture, result), _on_status(fixture, status) (e.g. ANDON updates) and
+        # _on_error(fixture, text) run on the aggregator thread.
+        self.fixtures = {fixture.name: fixture for fixture in _fixtures}
+        self.sinks = _sinks or {}
+        self.on_result = _on_result
+        self.on_status = _on_status
+        self.on_error = _on_error
+        self.max_restarts = _max_restarts
+        self.restart_delay = _restart_delay
+        self.mp = multiprocessing.get_context()
+        self.queue = self.mp.Queue()
+        self.stop_event = self.mp.Event()
+        self.processes = {}
+        self.restarts = {name: 0 for name in self.fixtures}
+        self.restart_at = {}
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        self.stop_event.clear()
+        for fixture in self.fixtures.values():
+            self._start(fixture)
+        for target, name in ((self._aggregate, "StationAggregator"), (self._monitor, "StationMonitor")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _start(self, _fixture:Fixture):
+        process = self.mp.Process(target=_worker_main, name=_fixture.name,
+                                  args=(_fixture.name, _fixture.target, _fixture.args, self.queue, self.stop_event))
+        process.start()
+        self.processes[_fixture.name] = process
+
+    def _aggregate(self):
+        while self.running:
+            try:
+                message = self.queue.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            self._dispatch(message)
+
+    def _dispatch(self, _message):
+        name, kind, payload = _message
+        # A failing handler must not stop the aggregation for the other nests
+        try:
+            if kind == self.MSG_RESULT and self.on_result is not None:
+                self.on_result(name, payload)
+            elif kind == self.MSG_LOG:
+                sink, row = payload
+                self.sinks[sink].escribirLog(row)
+            elif kind == self.MSG_STATUS and self.on_status is not None:
+                self.on_status(name, payload)
+            elif kind == self.MSG_ERROR:
+                self._error(name, payload)
+        except Exception:
+            print(f"Error handling {kind} from {name}: {traceback.format_exc()}")
+
+    def _error(self, _name:str, _text:str):
+        if self.on_error is not None:
+            self.on_error(_name, _text)
+        else:
+            print(f"Fixture {_name} failed:\n{_text}")
+
+    def _monitor(self):
+        # Restarts crashed workers (non zero exit code) with a delay, without touching the others
+        while self.running:
+            now = t.monotonic()
+            for name, process in list(self.processes.items()):
+                if process.is_alive() or process.exitcode == 0 or self.stop_event.is_set():
+                    continue
+                if name not in self.restart_at:
+                    if self.restarts[name] >= self.max_restarts:
+                        self._error(name, f"Exited with code {process.exitcode}, giving up after {self.restarts[name]} restarts")
+                        del self.processes[name]
+                        continue
+                    self.restart_at[name] = now + self.restart_delay
+                elif now >= self.restart_at[name]:
+                    del self.restart_at[name]
+                    self.restarts[name] += 1
+                    self._start(self.fixtures[name])
+            t.sleep(0.2)
+
+    def alive(self):
+        return [name for name, process in self.processes.items() if process.is_alive()]
+
+    def join(self, _timeout:float=None):
+        # Waits until every worker has finished on its own (crashed ones may still be restarted)
+        deadline = None if _timeout is None else t.monotonic() + _timeout
+        while any(process.is_alive() or process.exitcode != 0 for process in list(self.processes.values())):
+            if deadline is not None and t.monotonic() >= deadline:
+                return False
+            t.sleep(0.1)
+        return True
+
+    def stop(self, _timeout:float=10.0):
+        self.stop_event.set()
+        deadline = t.monotonic() + _timeout
+        for process in self.processes.values():
+            process.join(max(0.0, deadline - t.monotonic()))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        # Whatever the workers queued before exiting is still written
+        while True:
+            try:
+                self._dispatch(self.queue.get(timeout=0.1))
+            except queue.Empty:
+                break
+        for sink in self.sinks.values():
+            if hasattr(sink, 'guardar'):
+                sink.guardar()
@@ -0,0 +1,324 @@
+from collections import namedtuple
+import hashlib
+import json
+import os
+import time as t
+
+from .basic_tests import LimitTable
+from .fct_devs import DAQ, IOCard, rgbimModule
+
+# Bumped whenever the compiled layout changes, so plans cached by an older version are rebuilt
+PLAN_VERSION = 2
+
+DEVICE_DAQ = 'DAQ'
+DEVICE_IOCARD = 'IOCard'
+DEVICE_FEASA = 'FEASA'
+DEVICE_VISA = 'VISA'
+DEVICE_TYPES = (DEVICE_DAQ, DEVICE_IOCARD, DEVICE_FEASA, DEVICE_VISA)
+
+OP_SCAN = 'scan'
+OP_RELAY = 'relay'
+OP_OUTPUT = 'output'
+OP_WRITE = 'write'
+OP_QUERY = 'query'
+OP_RGBI = 'rgbi'
+OP_RGBIM = 'rgbim'
+OP_DELAY = 'delay'
+
+RGBI_SUFFIXES = ('R', 'G', 'B', 'I')
+RGBIM_SUFFIXES = ('R', 'G', 'B')
+READ_COMMAND = b'READ?\n'
+
+# One compiled step: values[start:stop] is what it fills, data is everything it sends, already encoded
+PlanStep = namedtuple('PlanStep', ['op', 'device', 'data', 'start', 'stop'])
+
+class TestPlan(namedtuple('TestPlan', ['name', 'devices', 'steps', 'table'])):
+    # Immutable; devices is ((name, type), ...), table the LimitTable of every value in buffer order
+    __slots__ = ()
+
+    def bind(self, _devices:dict):
+        return PlanRunner(self, _devices)
+
+class _Compiler():
+    # JSON plan -> TestPlan. Consecutive measure steps on the same DAQ become one scan.
+    def __init__(self, _source:dict):
+        self.source = _source
+        self.devices = dict(_source.get('devices', {}))
+        for name, kind in self.devices.items():
+            if kind not in DEVICE_TYPES:
+                raise ValueError(f"Device {name}: unknown type {kind}, expected one of {DEVICE_TYPES}")
+        self.steps = []
+        self.names, self.mins, self.maxs, self.units = [], [], [], []
+        self.scan = None
+
+    def compile(self):
+        for number, step in enumerate(self.source.get('steps', []), 1):
+            op = step.get('op')
+            compile_step = getattr(self, '_' + op, None) if op in ('measure', OP_RELAY, OP_WRITE, OP_QUERY, OP_RGBI, OP_RGBIM, OP_DELAY) else None
+            if compile_step is None:
+                raise ValueError(f"Step {number}: unknown op {op}")
+            if op != 'measure':
+                self._end_scan()
+            try:
+                compile_step(step)
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"Step {number} ({step.get('name', op)}): {e!r}") from e
+        self._end_scan()
+        table = LimitTable(self.names, self.mins, self.maxs, self.units)
+        return TestPlan(self.source.get('name', ''), tuple(self.devices.items()), tuple(self.steps), table)
+
+    def _device(self, _step:dict, *_types):
+        name = _step['device']
+        if self.devices.get(name) not in _types:
+            raise ValueError(f"Device {name} has to be declared as {' or '.join(_types)}")
+        return name
+
+    def _values(self, _name:str, _min, _max, _unit:str=''):
+        # Adds one limit row, returns its (start, stop) in the values buffer
+        self.names.append(_name)
+        self.mins.append(_min)
+        self.maxs.append(_max)
+        self.units.append(_unit)
+        return len(self.names) - 1, len(self.names)
+
+    def _measure(self, _step:dict):
+        device = self._device(_step, DEVICE_DAQ)
+        channel = int(_step['channel'])
+        setup = (_step.get('function', DAQ.FUNC_VOLTAGE), _step.get('range'), _step.get('resolution'))
+        if self.scan is not None and (self.scan[0] != device or channel in self.scan[1]):
+            self._end_scan()
+        if self.scan is None:
+            self.scan = (device, {}, len(self.names))
+        index, _stop = self._values(_step['name'], _step.get('min'), _step.get('max'), _step.get('unit', ''))
+        self.scan[1][channel] = (setup, index)
+
+    def _end_scan(self):
+        if self.scan is None:
+            return
+        device, channels, start = self.scan
+        self.scan = None
+        groups = {}
+        for channel, (setup, _index) in channels.items():
+            groups.setdefault(setup, []).append(channel)
+        # Same message DAQ.configure_scan sends for a cold cache
+        commands = [DAQ.conf_command(setup, group) for setup, group in groups.items()]
+        commands.append(f'ROUT:SCAN (@{DAQ.channel_list(channels)})')
+        order = tuple(sorted(channels))
+        data = (tuple((channel, channels[channel][0]) for channel in order), (';:'.join(commands) + '\n').encode(),
+                order, tuple(channels[channel][1] for channel in order))
+        self.steps.append(PlanStep(OP_SCAN, device, data, start, len(self.names)))
+
+    def _relay(self, _step:dict):
+        device = self._device(_step, DEVICE_DAQ, DEVICE_IOCARD)
+        if self.devices[device] == DEVICE_IOCARD:
+            # [module, channel] pairs, committed with one io_Update per module
+            outputs = [(int(m), int(c), True) for m, c in _step.get('close', [])]
+            outputs += [(int(m), int(c), False) for m, c in _step.get('open', [])]
+            self.steps.append(PlanStep(OP_OUTPUT, device, tuple(outputs), 0, 0))
+            return
+        closes = tuple(int(channel) for channel in _step.get('close', []))
+        opens = tuple(int(channel) for channel in _step.get('open', []))
+        commands = []
+        if closes:
+            commands.append(f'ROUT:CLOSE (@{DAQ.channel_list(closes)})')
+        if opens:
+            commands.append(f'ROUT:OPEN (@{DAQ.channel_list(opens)})')
+        if commands:
+            self.steps.append(PlanStep(OP_RELAY, device, (closes, opens, (';:'.join(commands) + '\n').encode()), 0, 0))
+
+    def _write(self, _step:dict):
+        device = self._device(_step, DEVICE_VISA, DEVICE_DAQ)
+        self.steps.append(PlanStep(OP_WRITE, device, (_step['command'] + '\n').encode(), 0, 0))
+
+    def _query(self, _step:dict):
+        device = self._device(_step, DEVICE_VISA, DEVICE_DAQ)
+        start, stop = self._values(_step['name'], _step.get('min'), _step.get('max'), _step.get('unit', ''))
+        self.steps.append(PlanStep(OP_QUERY, device, (_step['command'] + '\n').encode(), start, stop))
+
+    def _rgbi(self, _step:dict):
+        device = self._device(_step, DEVICE_FEASA)
+        fibers = tuple(int(fiber) for fiber in _step['fibers'])
+        start = len(self.names)
+        for fiber in fibers:
+            self._limit_rows(f"{_step['name']}_F{fiber}", RGBI_SUFFIXES, _step, str(fiber))
+        data = (fibers, tuple(b'Getrgbi' + b'%02d' % fiber for fiber in fibers), _step.get('use_all', True))
+        self.steps.append(PlanStep(OP_RGBI, device, data, start, len(self.names)))
+
+    def _rgbim(self, _step:dict):
+        device = self._device(_step, DEVICE_IOCARD)
+        modules = tuple((int(module['module']), tuple(int(led) for led in module['leds'])) for module in _step['modules'])
+        start = len(self.names)
+        for module, leds in modules:
+            for led in leds:
+                self._limit_rows(f"{_step['name']}_MOD{module}_FIB{led}", RGBIM_SUFFIXES, _step, f'MOD{module}_FIB{led}')
+        self.steps.append(PlanStep(OP_RGBIM, device, modules, start, len(self.names)))
+
+    def _limit_rows(self, _prefix:str, _suffixes:tuple, _step:dict, _key:str):
+        # min/max: one value, one per colour, or {key: per colour} for per-LED limits,
+        # keyed by fiber number for rgbi ("7") and by "MOD<module>_FIB<led>" for rgbim
+        limits = []
+        for key in ('min', 'max'):
+            value = _step.get(key)
+            if isinstance(value, dict):
+                if _key not in value:
+                    raise ValueError(f"{key} has no limits for {_key}")
+                value = value[_key]
+            if not isinstance(value, (list, tuple)):
+                value = [value] * len(_suffixes)
+            limits.append(value)
+        for i, suffix in enumerate(_suffixes):
+            self._values(f'{_prefix}_{suffix}', limits[0][i], limits[1][i], _step.get('unit', ''))
+
+    def _delay(self, _step:dict):
+        self.steps.append(PlanStep(OP_DELAY, None, float(_step['seconds']), 0, 0))
+
+def compile_plan(_source:dict):
+    return _Compiler(_source).compile()
+
+def _encode(_value):
+    # Compiled plans only hold tuples, bytes, numbers, strings, bools and None
+    if isinstance(_value, bytes):
+        return {'bytes': _value.decode('latin-1')}
+    if isinstance(_value, tuple):
+        return [_encode(value) for value in _value]
+    return _value
+
+def _decode(_value):
+    if isinstance(_value, dict):
+        return _value['bytes'].encode('latin-1')
+    if isinstance(_value, list):
+        return tuple(_decode(value) for value in _value)
+    return _value
+
+def dump_plan(_plan:TestPlan):
+    # Data only (no pickle), so a shared cache directory can't be used to run code on a station
+    table = _plan.table
+    return {'version': PLAN_VERSION, 'name': _plan.name, 'devices': _encode(_plan.devices),
+            'steps': [_encode(tuple(step)) for step in _plan.steps],
+            'table': {'names': list(table.names), 'min': table.min.tolist(), 'max': table.max.tolist(), 'units': list(table.units)}}
+
+def undump_plan(_data:dict):
+    if _data['version'] != PLAN_VERSION:
+        raise ValueError(f"Compiled plan version {_data['version']}, expected {PLAN_VERSION}")
+    table = _data['table']
+    return TestPlan(_data['name'], _decode(_data['devices']), tuple(PlanStep(*_decode(step)) for step in _data['steps']),
+                    LimitTable(table['names'], table['min'], table['max'], table['units']))
+
+def load_plan(_path:str, _cache_dir:str=None):
+    # Compiled plans are stored as JSON in _cache_dir under the sha256 of the plan file, so switching
+    # back to a product already seen doesn't compile again. Editing the plan changes the key.
+    with open(_path, 'rb') as _file:
+        content = _file.read()
+    cached = None
+    if _cache_dir is not None:
+        key = hashlib.sha256(b'%d\n' % PLAN_VERSION + content).hexdigest()
+        cached = os.path.join(_cache_dir, key + '.plan.json')
+        try:
+            with open(cached, 'r', encoding='utf-8') as _file:
+                return undump_plan(json.load(_file))
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    plan = compile_plan(json.loads(content))
+    if cached is not None:
+        os.makedirs(_cache_dir, exist_ok=True)
+        temp = f'{cached}.{os.getpid()}.tmp'
+        with open(temp, 'w', encoding='utf-8') as _file:
+            json.dump(dump_plan(plan), _file)
+        os.replace(temp, cached)
+    return plan
+
+class PlanRunner():
+    # A TestPlan bound to open devices: {device name: DAQ/IOCard/FEASA/instrument with .instrument}.
+    # Everything that can be built ahead is built here; run() only does I/O and fills self.values.
+    def __init__(self, _plan:TestPlan, _devices:dict):
+        import numpy as np
+        missing = [name for name, _kind in _plan.devices if name not in _devices]
+        if missing:
+            raise ValueError(f"Plan {_plan.name} needs devices {missing}")
+        self.plan = _plan
+        self.values = np.full(len(_plan.table), np.nan)
+        self.calls = []
+        for step in _plan.steps:
+            device = _devices.get(step.device)
+            extra = None
+            if step.op == OP_RGBI:
+                fibers, commands, _use_all = step.data
+                device.rgbi_commands.update(zip(fibers, commands))
+                extra = (self.values[step.start:step.stop].reshape(-1, 4), np.zeros(len(fibers), dtype=bool))
+            elif step.op == OP_RGBIM:
+                extra = device.rgbim_plan([rgbimModule(module, list(leds)) for module, leds in step.data])
+            self.calls.append((getattr(self, '_' + step.op), device, step, extra))
+        self.calls = tuple(self.calls)
+
+    def run(self):
+        # Returns the LimitResult of the whole plan; values that could not be read stay NaN and fail
+        values = self.values
+        values.fill(float('nan'))
+        for function, device, step, extra in self.calls:
+            function(device, step, extra)
+        return self.plan.table.evaluate(values)
+
+    def _scan(self, _daq:DAQ, _step:PlanStep, _extra):
+        setups, conf, order, positions = _step.data
+        instrument = _daq.instrument
+        with _daq.lock:
+            _daq._check_generation()
+            cache = _daq.config_cache
+            # Shares DAQ.configure_scan's cache, so plan steps and station code don't reconfigure each other needlessly
+            if _daq.scan_list != order or any(cache.get(channel) != setup for channel, setup in setups):
+                for channel, _setup in setups:
+                    cache.pop(channel, None)
+                _daq.scan_list = None
+                instrument.write_raw(conf)
+                cache.update(setups)
+                _daq.scan_list = order
+            instrument.write_raw(READ_COMMAND)
+            readings = instrument.read().split(',')
+        values = self.values
+        for position, reading in zip(positions, readings):
+            values[position] = float(reading)
+
+    def _relay(self, _daq:DAQ, _step:PlanStep, _extra):
+        closes, opens, message = _step.data
+        _daq._check_generation()
+        states = _daq.relay_states
+        if all(states.get(channel) is True for channel in closes) and all(states.get(channel) is False for channel in opens):
+            return
+        for channel in closes + opens:
+            states.pop(channel, None)
+        _daq.instrument.write_raw(message)
+        for channel in closes:
+            states[channel] = True
+        for channel in opens:
+            states[channel] = False
+
+    def _output(self, _iocard:IOCard, _step:PlanStep, _extra):
+        _iocard.begin_outputs()
+        for module, channel, value in _step.data:
+            _iocard.output(module, channel, value)
+        _iocard.commit_outputs()
+
+    def _write(self, _device, _step:PlanStep, _extra):
+        _device.instrument.write_raw(_step.data)
+
+    def _query(self, _device, _step:PlanStep, _extra):
+        _device.instrument.write_raw(_step.data)
+        reply = _device.instrument.read()
+        try:
+            self.values[_step.start] = float(reply)
+        except ValueError:
+            pass
+
+    def _rgbi(self, _feasa, _step:PlanStep, _extra):
+        fibers, _commands, use_all = _step.data
+        values, valid = _extra
+        if _feasa.capture() == 1:
+            _feasa.read_rgbi_into(fibers, values, valid, use_all)
+
+    def _rgbim(self, _iocard:IOCard, _step:PlanStep, _extra):
+        result, _values = _extra.read()
+        if result == IOCard.OK_RESULT:
+            self.values[_step.start:_step.stop] = _extra.buffer
+
+    def _delay(self, _device, _step:PlanStep, _extra):
+        t.sleep(_step.data)
@@ -0,0 +1,147 @@
+import threading
+import time as t
+
+class VISASession():
+    # Shared, lazily opened VISA resource. Behaves like the pyvisa resource it wraps.
+    def __init__(self, _rm, _resource_name:str, _open_timeout:int=3000, _idle_check:float=30.0, _backoff_min:float=0.5, _backoff_max:float=30.0):
+        self.rm = _rm
+        self.resource_name = _resource_name
+        self.open_timeout = _open_timeout
+        self.idle_check = _idle_check
+        self.backoff_min = _backoff_min
+        self.backoff_max = _backoff_max
+        self.resource = None
+        # Increments on every (re)connection so cached instrument state can be dropped
+        self._generation = 0
+        self._timeout = None
+        self.last_used = 0.0
+        self.failures = 0
+        self.retry_at = 0.0
+        self.users = 0
+        self.lock = threading.RLock()
+        # Instrument side state shared by every device object using this session (e.g. the DAQ configuration cache)
+        self.shared = {}
+
+    @property
+    def generation(self):
+        with self.lock:
+            self._acquire()
+            return self._generation
+
+    @property
+    def timeout(self):
+        return self._acquire().timeout
+
+    @timeout.setter
+    def timeout(self, _timeout):
+        with self.lock:
+            self._timeout = _timeout
+            if self.resource is not None:
+                self.resource.timeout = _timeout
+
+    def _open(self):
+        now = t.monotonic()
+        if now < self.retry_at:
+            raise ConnectionError(f"{self.resource_name} unavailable, next reconnect in {self.retry_at - now:.1f} s")
+        try:
+            self.resource = self.rm.open_resource(self.resource_name, access_mode=1, open_timeout=self.open_timeout)
+        except Exception as e:
+            self.failures += 1
+            self.retry_at = now + min(self.backoff_max, self.backoff_min * 2 ** (self.failures - 1))
+            print(f"Error opening instrument: {e}")
+            raise ConnectionError(f"Cannot open {self.resource_name}: {e}") from e
+        if self._timeout is not None:
+            self.resource.timeout = self._timeout
+        self.failures = 0
+        self._generation += 1
+        self.last_used = now
+
+    def _drop(self):
+        try:
+            self.resource.close()
+        except Exception:
+            pass
+        self.resource = None
+
+    def _acquire(self):
+        with self.lock:
+            if self.resource is None:
+                self._open()
+            elif t.monotonic() - self.last_used > self.idle_check:
+                # Cheap health check only after the session has been idle for a while
+                try:
+                    self.resource.query('*OPC?')
+                except Exception:
+                    self._drop()
+                    self._open()
+            self.last_used = t.monotonic()
+            return self.resource
+
+    def _call(self, _name:str, *args, **kwargs):
+        with self.lock:
+            resource = self._acquire()
+            try:
+                return getattr(resource, _name)(*args, **kwargs)
+            except Exception:
+                # Force a health check (and a reconnect if the link is gone) on the next call
+                self.last_used = 0.0
+                raise
+
+    def write(self, *args, **kwargs):
+        return self._call('write', *args, **kwargs)
+
+    def query(self, *args, **kwargs):
+        return self._call('query', *args, **kwargs)
+
+    def read(self, *args, **kwargs):
+        return self._call('read', *args, **kwargs)
+
+    def read_raw(self, *args, **kwargs):
+        return self._call('read_raw', *args, **kwargs)
+
+    def write_raw(self, *args, **kwargs):
+        return self._call('write_raw', *args, **kwargs)
+
+    def query_binary_values(self, *args, **kwargs):
+        return self._call('query_binary_values', *args, **kwargs)
+
+    def shared_state(self, _name:str, _factory):
+        with self.lock:
+            state = self.shared.get(_name)
+            if state is None:
+                state = self.shared[_name] = _factory()
+            return state
+
+    def __getattr__(self, _name):
+        return getattr(self._acquire(), _name)
+
+    def close(self):
+        # Devices only release the session; the pool keeps it open for the next sequence
+        with self.lock:
+            self.users = max(0, self.users - 1)
+
+    def disconnect(self):
+        with self.lock:
+            if self.resource is not None:
+                self._drop()
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(_rm, _resource_name:str, **kwargs):
+    # One session per resource manager and resource; the session keeps _rm alive, so its id can't be reused
+    key = (id(_rm), _resource_name)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = VISASession(_rm, _resource_name, **kwargs)
+            _sessions[key] = session
+    with session.lock:
+        session.users += 1
+    return session
+
+def close_all():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.disconnect()
+        _sessions.clear()